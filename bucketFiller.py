@@ -1,25 +1,213 @@
 from PythonQt import QtGui, Qt
 import KnossosModule
-import numpy, os, re, string, sys, time, traceback
+import numpy, os, re, string, sys, time, traceback, threading, Queue, collections, json, contextlib
 from scipy import ndimage
 from knossos_utils import knossosdataset, KnossosDataset
 knossosdataset._set_noprint(True)
+try:
+    import resource
+except ImportError:
+    # Not on Windows, where the peak rise of phases is not recorded
+    resource = None
 
 #KNOSSOS_PLUGIN	Version	1
 #KNOSSOS_PLUGIN	Description	Iteratively bucket fill a segmentation object based on a pre-calculated membrane prediction
 
+knossosDatasets = {}
+knossosDatasetsLock = threading.Lock()
+
+def knossosDatasetAt(path):
+    # Datasets are shared process-wide, so knossos.conf is parsed once per path
+    with knossosDatasetsLock:
+        if path not in knossosDatasets:
+            dataset = KnossosDataset.knossosDataset()
+            dataset.initialize_from_knossos_path(path)
+            knossosDatasets[path] = dataset
+        return knossosDatasets[path]
+
 class main_class(QtGui.QWidget):
     INSTRUCTION_TEXT_STR = """Fill configuration:
 - Pick membrane prediction dataset by browsing to directory of knossos.conf
 - Base subobject ID for subobjects to be created
 - Size of work area,  as an x,y,z blank-separated tuple
   Work area should not exceed supercube size
+- Iterations - radius (voxels along the finest axis) of the diamond dilating the membrane prediction. Steps along
+  an axis count by its voxel scale, so at isotropic scale this is as many dilations by the 6-neighbour cross
+- Prefetch MB - size cap of the membrane prediction cubes kept in memory
 
 Operation:
 - For each cell, enter a subObject Id. Then iteratively:
 -- Move to a place inside the cell (stay in mag1), and wait for the loader to finish
 -- Click Fill to bucket fill
+- Upon each middle-click, membrane prediction around the clicked position, and further along the direction
+  moved from the previous click, is read in the background, so that Fill does not wait for it
+- The wall time, CPU time and memory of the phases of the latest Fill are shown below the buttons. Memory is
+  the resident size at the begin and end of a phase, and how much the peak resident size rose during it
+  (n/a where not available).
+  Dump Trace... saves the recent ones to a file, as CSV if its name ends with .csv and as JSON otherwise
 """
+    PREFETCH_SIZE_MB = 256
+
+    class PhaseTimer:
+        # Wall time, CPU time and resident memory of named phases, the latest records kept in a ring buffer.
+        # Memory is the resident size at the begin and end of a phase, and how much the peak resident size of
+        # the process rose during it. CPU time and memory are of the whole process. Phases may be timed on any thread
+        FIELDS = ["phase", "begin", "wall_sec", "cpu_sec", "rss_begin_mb", "rss_end_mb", "peak_rise_mb"]
+
+        def __init__(self, capacity=10000):
+            self.records = collections.deque(maxlen=capacity)
+            self.latest = collections.OrderedDict()
+            self.lock = threading.Lock()
+            return
+
+        def cpuTime(self):
+            times = os.times()
+            return times[0] + times[1]
+
+        def rssMB(self):
+            # Current resident size, where /proc is available
+            try:
+                with open("/proc/self/statm") as f:
+                    pages = int(f.read().split()[1])
+            except (IOError, IndexError, ValueError):
+                return None
+            return pages*os.sysconf("SC_PAGE_SIZE")/1048576.0
+
+        def maxRssMB(self):
+            if resource is None:
+                return None
+            # Kilobytes on Linux, bytes on macOS
+            maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxRss/(1048576.0 if sys.platform == "darwin" else 1024.0)
+
+        def memoryMB(self, val):
+            if val is None:
+                return "n/a"
+            return "%.1f MB" % val
+
+        @contextlib.contextmanager
+        def phase(self, name):
+            (begin, cpu, rssBegin, maxRssBegin) = (time.time(), self.cpuTime(), self.rssMB(), self.maxRssMB())
+            try:
+                yield
+            finally:
+                (wall, cpu) = (time.time() - begin, self.cpuTime() - cpu)
+                maxRssEnd = self.maxRssMB()
+                peakRise = None if maxRssBegin is None else maxRssEnd - maxRssBegin
+                record = (name, begin, wall, cpu, rssBegin, self.rssMB(), peakRise)
+                with self.lock:
+                    self.records.append(record)
+                    self.latest.pop(name, None)
+                    self.latest[name] = record
+            return
+
+        def timed(self, name, func):
+            def timedFunc(*args):
+                with self.phase(name):
+                    return func(*args)
+            return timedFunc
+
+        def breakdown(self):
+            with self.lock:
+                records = self.latest.values()
+            if len(records) == 0:
+                return ""
+            return "\n".join(["%s: %.3f s (CPU %.3f s), memory %s to %s, peak rise %s" % \
+                              (name, wall, cpu, self.memoryMB(rssBegin), self.memoryMB(rssEnd), self.memoryMB(peakRise)) \
+                              for (name, begin, wall, cpu, rssBegin, rssEnd, peakRise) in records])
+
+        def dump(self, path):
+            with self.lock:
+                records = list(self.records)
+            with open(path, "w") as f:
+                if path.lower().endswith(".csv"):
+                    f.write(",".join(self.FIELDS) + "\n")
+                    for record in records:
+                        f.write(",".join([record[0]] + ["" if val is None else repr(val) for val in record[1:]]) + "\n")
+                else:
+                    json.dump([dict(zip(self.FIELDS, record)) for record in records], f, indent=1)
+            return
+        pass
+
+    class CubePrefetcher:
+        # Bounded LRU of dataset blocks, aligned to knossos cubes. Regions are assembled from cached blocks,
+        # reading missing ones on the spot. A worker thread warms the blocks of the latest prefetched regions
+        def __init__(self, edge, capacityBytes):
+            self.edge = edge
+            self.capacityBytes = capacityBytes
+            self.blocks = collections.OrderedDict()
+            self.cachedBytes = 0
+            self.lock = threading.Lock()
+            self.requests = Queue.Queue()
+            self.generation = 0
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            return
+
+        def blockBegins(self, offset, size):
+            first = (offset // self.edge) * self.edge
+            ranges = [xrange(first[axis], offset[axis] + size[axis], self.edge) for axis in xrange(3)]
+            return [numpy.array((x, y, z)) for x in ranges[0] for y in ranges[1] for z in ranges[2]]
+
+        def block(self, path, begin):
+            key = (path, tuple(begin))
+            with self.lock:
+                if key in self.blocks:
+                    block = self.blocks.pop(key)
+                    self.blocks[key] = block
+                    return block
+            block = knossosDatasetAt(path).from_cubes_to_matrix([self.edge]*3, list(begin), type='raw')
+            with self.lock:
+                if key not in self.blocks:
+                    self.blocks[key] = block
+                    self.cachedBytes += block.nbytes
+                while (self.cachedBytes > self.capacityBytes) and (len(self.blocks) > 0):
+                    self.cachedBytes -= self.blocks.popitem(last=False)[1].nbytes
+            return block
+
+        def read(self, path, offset, size):
+            offset = numpy.array(offset)
+            size = numpy.array(size)
+            matrix = None
+            for begin in self.blockBegins(offset, size):
+                block = self.block(path, begin)
+                if matrix is None:
+                    matrix = numpy.empty(size, dtype=block.dtype)
+                lo = numpy.maximum(begin, offset)
+                hi = numpy.minimum(begin + self.edge, offset + size)
+                matrix[tuple([slice(l, h) for (l, h) in zip(lo - offset, hi - offset)])] = \
+                    block[tuple([slice(l, h) for (l, h) in zip(lo - begin, hi - begin)])]
+            return matrix
+
+        def prefetch(self, path, regions):
+            # Supersedes regions still being prefetched
+            self.generation += 1
+            self.requests.put((self.generation, path, [(numpy.array(offset), numpy.array(size)) for (offset, size) in regions]))
+            return
+
+        def run(self):
+            while True:
+                request = self.requests.get()
+                if request is None:
+                    return
+                (generation, path, regions) = request
+                for (offset, size) in regions:
+                    for begin in self.blockBegins(offset, size):
+                        if generation <> self.generation:
+                            break
+                        try:
+                            self.block(path, begin)
+                        except:
+                            # Best effort, a later read reports the error
+                            break
+            return
+
+        def stop(self):
+            self.requests.put(None)
+            return
+        pass
+
     def initGUI(self):
         self.twiHeadersList = []
         self.twiHash = {}
@@ -58,6 +246,12 @@ Operation:
         itersThresholdLayout.addWidget(QtGui.QLabel("Threshold"))
         self.thresholdEdit = QtGui.QLineEdit()
         itersThresholdLayout.addWidget(self.thresholdEdit)
+        prefetchLayout = QtGui.QHBoxLayout()
+        configLayout.addLayout(prefetchLayout)
+        prefetchLayout.addWidget(QtGui.QLabel("Prefetch MB"))
+        self.prefetchSizeEdit = QtGui.QLineEdit()
+        self.prefetchSizeEdit.setText(str(self.PREFETCH_SIZE_MB))
+        prefetchLayout.addWidget(self.prefetchSizeEdit)
         fillUndoLayout = QtGui.QHBoxLayout()
         layout.addLayout(fillUndoLayout)
         self.fillButton = QtGui.QPushButton("Fill")
@@ -66,6 +260,13 @@ Operation:
         self.UndoButton = QtGui.QPushButton("Undo")
         self.UndoButton.clicked.connect(self.UndoButtonClicked)
         fillUndoLayout.addWidget(self.UndoButton)
+        phasesLayout = QtGui.QHBoxLayout()
+        layout.addLayout(phasesLayout)
+        self.phasesLabel = QtGui.QLabel()
+        phasesLayout.addWidget(self.phasesLabel)
+        self.dumpTraceButton = QtGui.QPushButton("Dump Trace...")
+        self.dumpTraceButton.clicked.connect(self.dumpTraceButtonClicked)
+        phasesLayout.addWidget(self.dumpTraceButton)
         # Show
         self.setWindowFlags(Qt.Qt.Window)
         self.show()
@@ -81,11 +282,36 @@ Operation:
     def initLogic(self):
         KnossosModule.signalRelay.Signal_EventModel_handleMouseReleaseMiddle.connect(self.handleMouseReleaseMiddle)
         self.pos_arr = numpy.array(KnossosModule.knossos.getPosition())
+        self.phases = self.PhaseTimer()
+        self.prefetcher = self.CubePrefetcher(KnossosModule.knossos.getCubeEdgeLength(), self.PREFETCH_SIZE_MB*(2**20))
+        return
+
+    def uninitLogic(self):
+        KnossosModule.signalRelay.Signal_EventModel_handleMouseReleaseMiddle.disconnect(self.handleMouseReleaseMiddle)
+        self.prefetcher.stop()
+        return
+
+    def closeEvent(self,event):
+        self.uninitLogic()
+        event.accept()
         return
     
     def handleMouseReleaseMiddle(self, eocd, coord, event):
+        delta = numpy.array(coord.vector()) - self.pos_arr
         self.pos_arr = numpy.array(coord.vector())
         KnossosModule.knossos.setPosition(coord.vector())
+        self.prefetch(delta)
+        return
+
+    def prefetch(self, delta):
+        try:
+            path = self.validateDir(str(self.dirEdit.text))
+            size_arr = numpy.array(self.str2tripint(str(self.workAreaSizeEdit.text)))
+            self.prefetcher.capacityBytes = long(str(self.prefetchSizeEdit.text))*(2**20)
+        except:
+            return
+        begin_arr = self.pos_arr - size_arr/2
+        self.prefetcher.prefetch(path, [(begin_arr, size_arr), (begin_arr + delta, size_arr)])
         return
     
     def instructionsButtonClicked(self):
@@ -118,36 +344,60 @@ Operation:
     def readMatrix(self, matrix):
         return KnossosModule.knossos.processRegionByStridedBufProxy(self.begin_arr, self.size_arr, self.npDataPtr(matrix), matrix.strides, False, False)
 
+    def voxelSampling(self):
+        # Voxel scale relative to the finest axis, so that distances remain in voxels along it
+        scale = numpy.array(KnossosModule.knossos.getScale(), dtype="float64")
+        return tuple(map(float, scale / scale.min()))
+
+    def diamond(self, radius, sampling):
+        # Structuring element of the voxels within radius of its center, summing the scaled steps along each axis.
+        # Isotropically, it is what radius iterations by the cross reach, so a dilation by it is the same as those
+        halfSizes = numpy.floor(radius / numpy.array(sampling)).astype("int64")
+        grid = numpy.ogrid[tuple([slice(-halfSize, halfSize + 1) for halfSize in halfSizes])]
+        return sum([abs(axisGrid)*scale for (axisGrid, scale) in zip(grid, sampling)]) <= radius
+
     def fillButtonClicked(self):
         path = self.validateDir(str(self.dirEdit.text))
         self.size_arr = numpy.array(self.str2tripint(str(self.workAreaSizeEdit.text)))
         subObjId = int(str(self.subObjIdEdit.text))
         iters = int(str(self.itersEdit.text))
         threshold = int(str(self.thresholdEdit.text))
+        self.prefetcher.capacityBytes = long(str(self.prefetchSizeEdit.text))*(2**20)
         pos_off_arr = self.size_arr/2
         self.begin_arr = self.pos_arr - pos_off_arr
         
-        memPredDataset = KnossosDataset.knossosDataset()
-        memPredDataset.initialize_from_knossos_path(path)
-        memPred = memPredDataset.from_cubes_to_matrix(self.size_arr, self.begin_arr, type='raw')
+        with self.phases.phase("read"):
+            memPred = self.prefetcher.read(path, self.begin_arr, self.size_arr)
 	
-        dil = ndimage.morphology.binary_dilation(memPred > threshold, iterations = iters)
+        sampling = self.voxelSampling()
+        with self.phases.phase("dilate"):
+            dil = ndimage.morphology.binary_dilation(memPred > threshold, self.diamond(iters, sampling))
         del memPred
         if dil[tuple(pos_off_arr)]:
             QtGui.QMessageBox.information(0, "Error", "Dilation error")
             return
-        all_labels, num = ndimage.measurements.label(numpy.invert(dil))
-        del dil
-        requested_label = all_labels[tuple(pos_off_arr)]
-        seg = ndimage.morphology.binary_dilation((all_labels == requested_label), iterations = iters + 1)
-        del all_labels
-        self.inputMatrix = numpy.ndarray(shape=self.size_arr,dtype="uint64")
-        self.inputMatrix.fill(0)
-        self.readMatrix(self.inputMatrix)
-        outputMatrix = numpy.ndarray(shape=self.size_arr,dtype="uint64")
-        outputMatrix[:,:,:] = self.inputMatrix[:,:,:]
-        outputMatrix[seg] = subObjId
-        self.writeMatrix(outputMatrix)
+        with self.phases.phase("label"):
+            all_labels, num = ndimage.measurements.label(numpy.invert(dil))
+            del dil
+            requested_label = all_labels[tuple(pos_off_arr)]
+            seg = ndimage.morphology.binary_dilation((all_labels == requested_label), self.diamond(iters + 1, sampling))
+            del all_labels
+        with self.phases.phase("write"):
+            self.inputMatrix = numpy.ndarray(shape=self.size_arr,dtype="uint64")
+            self.inputMatrix.fill(0)
+            self.readMatrix(self.inputMatrix)
+            outputMatrix = numpy.ndarray(shape=self.size_arr,dtype="uint64")
+            outputMatrix[:,:,:] = self.inputMatrix[:,:,:]
+            outputMatrix[seg] = subObjId
+            self.writeMatrix(outputMatrix)
+        self.phasesLabel.text = self.phases.breakdown()
+        return
+
+    def dumpTraceButtonClicked(self):
+        path = str(QtGui.QFileDialog.getSaveFileName(0, "Dump Trace", "", "JSON (*.json);;CSV (*.csv)"))
+        if path == "":
+            return
+        self.phases.dump(path)
         return
     
     def UndoButtonClicked(self):
@@ -0,0 +1,52 @@
+import json, os
+import pytest
+from harness import loadPlugin
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.json")
+
+def pytest_addoption(parser):
+    parser.addoption("--update-results", action="store_true", \
+                     help="store the results of this run as the reference that benchmarks are checked against")
+    return
+
+@pytest.fixture(scope="session")
+def segmentorModule():
+    return loadPlugin("watershedCubeSegmentor")
+
+@pytest.fixture(scope="session")
+def splitterModule():
+    return loadPlugin("watershedSplitter")
+
+@pytest.fixture(scope="session")
+def referenceResults(request):
+    # Results of the reference run per test. With --update-results, this run's replace them once done
+    reference = {}
+    if os.path.isfile(RESULTS_PATH):
+        with open(RESULTS_PATH) as f:
+            reference = json.load(f)
+    yield reference
+    if request.config.getoption("--update-results"):
+        with open(RESULTS_PATH, "w") as f:
+            json.dump(reference, f, indent=1, sort_keys=True, separators=(",", ": "))
+            f.write("\n")
+    return
+
+@pytest.fixture
+def results(request, referenceResults):
+    # Checks what a session of the test resulted in against the reference run
+    def check(session):
+        if request.config.getoption("--update-results"):
+            referenceResults[request.node.name] = session.results()
+        else:
+            assert session.results() == referenceResults.get(request.node.name)
+        return
+    return check
+
+@pytest.fixture
+def sessions():
+    # Sessions opened by a test, closed after it
+    opened = []
+    yield opened
+    for session in opened:
+        session.close()
+    return
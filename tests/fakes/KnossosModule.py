@@ -0,0 +1,151 @@
+# Stand-in for the KnossosModule knossos provides to plugins, so that they run headless.
+# The segmentation is an in-memory volume, read and written by processRegionByStridedBufProxy
+import ctypes
+import mock
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+knossos_global_mainwindow = None
+scripting = mock.MagicMock()
+scripting.getInstanceInContainerStr.return_value = "pluginInstance"
+signalRelay = mock.MagicMock()
+
+class Loader(object):
+    def isFinished(self):
+        return True
+    pass
+
+knossos_global_loader = Loader()
+
+class Knossos(object):
+    def __init__(self):
+        self.reset((0, 0, 0))
+        return
+
+    def reset(self, shape, scale=(10.0, 10.0, 25.0), cubeEdge=64):
+        self.segmentation = numpy.zeros(shape, dtype="uint64")
+        self.scale = scale
+        self.cubeEdge = cubeEdge
+        self.position = tuple([dim / 2 for dim in shape])
+        self.movementArea = [0, 0, 0] + [dim - 1 for dim in shape]
+        self.writtenVoxels = 0
+        return
+
+    def getPosition(self):
+        return self.position
+
+    def setPosition(self, coord):
+        self.position = tuple(coord)
+        return
+
+    def getCubeEdgeLength(self):
+        return self.cubeEdge
+
+    def getScale(self):
+        return self.scale
+
+    def getMovementArea(self):
+        return list(self.movementArea)
+
+    def setMovementArea(self, begin, end):
+        self.movementArea = list(begin) + [coord - 1 for coord in end]
+        return
+
+    def resetMovementArea(self):
+        self.movementArea = [0, 0, 0] + [dim - 1 for dim in self.segmentation.shape]
+        return
+
+    def processRegionByStridedBufProxy(self, begin, dims, ptr, strides, isWrite, isChanged):
+        # Plugins pass the data pointer and strides of a uint64 matrix
+        dims = tuple([int(dim) for dim in dims])
+        size = sum([(dim - 1)*stride for (dim, stride) in zip(dims, strides)])/8 + 1
+        buf = numpy.frombuffer((ctypes.c_uint64 * size).from_address(ptr), dtype="uint64")
+        matrix = as_strided(buf, shape=dims, strides=strides)
+        region = tuple([slice(int(start), int(start) + dim) for (start, dim) in zip(begin, dims)])
+        if isWrite:
+            self.segmentation[region] = matrix
+            self.writtenVoxels += matrix.size
+        else:
+            matrix[...] = self.segmentation[region]
+        return
+    pass
+
+knossos = Knossos()
+
+class Node(object):
+    def __init__(self, nodeId, coord):
+        self.nodeId = nodeId
+        self.coord = coord
+        return
+
+    def coordinate(self):
+        return self
+
+    def vector(self):
+        return self.coord
+    pass
+
+class Tree(object):
+    def __init__(self, treeId):
+        self.treeId = treeId
+        self.nodeList = []
+        return
+
+    def nodes(self):
+        return list(self.nodeList)
+    pass
+
+class Skeleton(object):
+    def __init__(self):
+        self.treeMap = {}
+        self.nodeCount = 0
+        self.activeNodeId = None
+        return
+
+    def findAvailableTreeID(self):
+        return max(self.treeMap.keys() + [0]) + 1
+
+    def findAvailableNodeID(self):
+        return self.nodeCount + 1
+
+    def add_tree(self, treeId):
+        self.treeMap[treeId] = Tree(treeId)
+        return
+
+    def add_node(self, nodeId, x, y, z, treeId, radius, vpId):
+        self.nodeCount = max(self.nodeCount, nodeId)
+        self.treeMap[treeId].nodeList.append(Node(nodeId, (x, y, z)))
+        return
+
+    def delete_tree(self, treeId):
+        self.treeMap.pop(treeId, None)
+        return
+
+    def set_active_node(self, nodeId):
+        self.activeNodeId = nodeId
+        return
+
+    def trees(self):
+        return self.treeMap.values()
+    pass
+
+skeleton = Skeleton()
+
+class Segmentation(object):
+    # Objects are identified with their single subobject
+    def __init__(self):
+        self.comments = {}
+        return
+
+    def subobjectFromId(self, subObjId, coord):
+        return
+
+    def largestObjectContainingSubobject(self, subObjId, coord):
+        return subObjId
+
+    def changeComment(self, objId, comment):
+        self.comments[objId] = comment
+        return
+    pass
+
+segmentation = Segmentation()
@@ -0,0 +1,156 @@
+# Stand-in for the PythonQt bindings knossos embeds. Widgets keep the state plugins read back (edit
+# texts, check states, table rows), timers never fire, and message boxes are recorded in messages
+import mock
+
+messages = []
+
+class Widget(object):
+    # Any call not modelled here is accepted and ignored
+    def __init__(self, *args, **kwargs):
+        self.__dict__["text"] = ""
+        self.__dict__["enabled"] = True
+        self.__dict__["checked"] = False
+        return
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        attr = mock.MagicMock()
+        self.__dict__[name] = attr
+        return attr
+
+    def setText(self, text):
+        self.text = text
+        return
+
+    def setChecked(self, isChecked):
+        self.checked = bool(isChecked)
+        return
+
+    def isChecked(self):
+        return self.checked
+    pass
+
+class TableItem(object):
+    def __init__(self, text):
+        self.itemText = text
+        return
+
+    def text(self):
+        return self.itemText
+
+    def flags(self):
+        return 0
+
+    def setFlags(self, flags):
+        return
+
+    def setFont(self, font):
+        return
+    pass
+
+class Table(Widget):
+    def __init__(self, *args, **kwargs):
+        Widget.__init__(self)
+        self.__dict__["rows"] = []
+        self.__dict__["selectedRows"] = []
+        return
+
+    @property
+    def rowCount(self):
+        return len(self.rows)
+
+    def insertRow(self, row):
+        self.rows.insert(row, {})
+        return
+
+    def setRowCount(self, count):
+        del self.rows[count:]
+        return
+
+    def setItem(self, row, col, item):
+        self.rows[row][col] = item
+        return
+
+    def item(self, row, col):
+        return self.rows[row][col]
+
+    def selectRow(self, row):
+        self.selectedRows = [row]
+        return
+
+    def selectionModel(self):
+        model = mock.MagicMock()
+        model.selectedRows.return_value = [mock.MagicMock(**{"row.return_value": row}) for row in self.selectedRows]
+        return model
+    pass
+
+class Size(object):
+    def width(self):
+        return 100
+
+    def height(self):
+        return 100
+    pass
+
+class QWidget(object):
+    size = Size()
+
+    def __init__(self, *args, **kwargs):
+        return
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        attr = mock.MagicMock()
+        object.__setattr__(self, name, attr)
+        return attr
+    pass
+
+def information(parent, title, text, *args):
+    messages.append(text)
+    return
+
+class Settings(object):
+    def __init__(self, *args):
+        return
+
+    def beginGroup(self, group):
+        return
+
+    def endGroup(self):
+        return
+
+    def value(self, key):
+        return None
+
+    def setValue(self, key, value):
+        return
+    pass
+
+class Namespace(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+        return
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        attr = mock.MagicMock()
+        self.__dict__[name] = attr
+        return attr
+    pass
+
+class QtConstants(object):
+    Key_Delete = 1; Key_Space = 2; Key_B = 3
+    ControlModifier = 4; ShiftModifier = 8; AltModifier = 16
+    Checked = 2
+
+    def __getattr__(self, name):
+        return 0
+    pass
+
+QtGui = Namespace(QWidget=QWidget, QLineEdit=Widget, QCheckBox=Widget, QPushButton=Widget, QLabel=Widget, \
+                  QComboBox=Widget, QTableWidget=Table, QTableWidgetItem=TableItem, \
+                  QMessageBox=Namespace(information=information, Yes=1, No=2))
+Qt = Namespace(Qt=QtConstants(), QTimer=Widget, QSettings=Settings)
@@ -0,0 +1,188 @@
+# Headless harness for the plugins: fakes of PythonQt, KnossosModule and knossos_utils are imported
+# in place of the real ones, and synthetic volumes stand in for the dataset
+import hashlib, imp, os, sys
+import numpy
+from scipy import ndimage
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGINS_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, os.path.join(TESTS_DIR, "fakes"))
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import KnossosModule, PythonQt
+from knossos_utils import KnossosDataset
+
+MEMBRANE_DIR = TESTS_DIR
+CELL_EDGE = 12
+
+class Coordinate(object):
+    def __init__(self, coord):
+        self.coord = tuple([int(val) for val in coord])
+        return
+
+    def vector(self):
+        return self.coord
+    pass
+
+class MouseEvent(object):
+    def __init__(self, mods):
+        self.mods = mods
+        return
+
+    def modifiers(self):
+        return self.mods
+    pass
+
+def loadPlugin(name):
+    return imp.load_source(name, os.path.join(PLUGINS_DIR, name + ".py"))
+
+def synthVolumes(shape, seed=0, isScaled=False, holeFraction=0.0):
+    # Voronoi cells about CELL_EDGE voxels across, with the membrane prediction high on their borders.
+    # If isScaled, cells are that size at the voxel scale of the dataset, so flatter along a coarser axis.
+    # holeFraction of the membrane prediction is left out in smooth patches, as where a prediction misses.
+    # Neighbouring cells are grouped into objects of the segmentation, separated by unlabelled borders.
+    # Returns the cell centers
+    KnossosModule.knossos.reset(shape)
+    sampling = numpy.ones(3)
+    if isScaled:
+        scale = numpy.array(KnossosModule.knossos.getScale())
+        sampling = scale / scale.min()
+    rs = numpy.random.RandomState(seed)
+    cellNum = max(int(numpy.prod(shape*sampling)) / CELL_EDGE**3, 2)
+    centers = numpy.array([rs.randint(0, dim, size=cellNum) for dim in shape]).T
+    cells = nearestLabels(shape, centers, sampling)
+    membrane = bordersOf(cells)
+    objCenters = centers[rs.permutation(cellNum)[:max(cellNum / 4, 2)]]
+    objOfCell = numpy.append(0, nearestLabels(shape, objCenters, sampling)[tuple(centers.T)])
+    objs = objOfCell[cells]
+    membrane = ndimage.binary_dilation(membrane)
+    if holeFraction > 0:
+        noise = ndimage.gaussian_filter(rs.rand(*shape), 3)
+        membrane &= noise < numpy.percentile(noise, 100*(1 - holeFraction))
+    KnossosDataset.membrane = (membrane*255).astype("uint8")
+    del KnossosDataset.reads[:]
+    KnossosModule.knossos.segmentation[...] = numpy.where(bordersOf(objs), 0, objs)
+    return centers
+
+def nearestLabels(shape, centers, sampling):
+    sites = numpy.zeros(shape, dtype="int64")
+    sites[tuple(centers.T)] = numpy.arange(1, len(centers) + 1)
+    inds = ndimage.distance_transform_edt(sites == 0, sampling=sampling, return_distances=False, return_indices=True)
+    return sites[tuple(inds)]
+
+def bordersOf(labels):
+    borders = numpy.zeros(labels.shape, dtype="bool")
+    for axis in xrange(3):
+        region = (slice(None),)*axis + (slice(0, -1),)
+        borders[region] |= numpy.diff(labels, axis=axis) <> 0
+    return borders
+
+def click(plugin, coord, mods=0):
+    plugin.handleMouseReleaseMiddle(None, Coordinate(coord), 0, MouseEvent(mods))
+    plugin.executor.flush()
+    return
+
+def digest(matrix):
+    return hashlib.md5(numpy.ascontiguousarray(matrix).tobytes()).hexdigest()
+
+def objectResults(ws, sizes):
+    # What a session resulted in, comparable with the results of a reference run: digests of the watershed
+    # (as object IDs) and of the segmentation exported to knossos, and the size of every object
+    return {"ws": digest(ws.astype("int64")), "exported": digest(KnossosModule.knossos.segmentation), \
+            "sizes": dict([(str(int(Id)), int(size)) for (Id, size) in sizes])}
+
+def innerCenters(centers, begin, end):
+    inside = numpy.all((centers >= begin) & (centers < end), axis=1)
+    return [tuple(center) for center in centers[inside] if not KnossosDataset.membrane[tuple(center)]]
+
+class SegmentorSession(object):
+    # Watershed Cube Segmentor on a work area of size^3 voxels, in a volume leaving room for its margin.
+    # Further arguments are passed on to synthVolumes
+    margin = 8
+
+    def __init__(self, module, size, **volumeArgs):
+        self.begin = self.margin + 2
+        self.centers = synthVolumes((size + 2*self.begin,)*3, **volumeArgs)
+        self.plugin = module.main_class()
+        plugin = self.plugin
+        plugin.dirEdit.text = MEMBRANE_DIR
+        plugin.workAreaBeginEdit.text = str((self.begin + 1,)*3)
+        plugin.workAreaSizeEdit.text = str((size,)*3)
+        plugin.marginEdit.text = str(self.margin)
+        plugin.memThresEdit.text = "150"
+        plugin.minObjSizeEdit.text = "10"
+        plugin.cacheSizeEdit.text = "0"
+        plugin.checkpointSecEdit.text = "0"
+        plugin.edtWorkersEdit.text = "1"
+        plugin.isSlackCheckBox.setChecked(True)
+        self.seeds = innerCenters(self.centers, self.begin, self.begin + size)
+        return
+
+    def start(self):
+        assert self.plugin.beginButtonClicked(), PythonQt.messages
+        return
+
+    def seed(self, count):
+        for coord in self.seeds[:count]:
+            click(self.plugin, coord)
+        return
+
+    def seedIds(self):
+        return [Id for Id in sorted(self.plugin.mapIdToCoord.keys()) if self.plugin.IsNormalId(Id)]
+
+    def results(self):
+        # Sizes as kept by the plugin, which checks new basins against them
+        plugin = self.plugin
+        sizes = [(plugin.labelToId[label], size) for (label, size) in enumerate(plugin.labelSizes) if size > 0]
+        return objectResults(plugin.labelToId[plugin.WS], sizes)
+
+    def close(self):
+        if self.plugin.active:
+            self.plugin.resetButtonClicked()
+        self.plugin.uninitLogic()
+        return
+    pass
+
+class SplitterSession(object):
+    # Watershed Splitter on a work area of size^3 voxels around the position, splitting its largest object
+    def __init__(self, module, size):
+        self.centers = synthVolumes((size + 8,)*3)
+        self.plugin = module.main_class()
+        plugin = self.plugin
+        plugin.workAreaSizeEdit.text = str((size,)*3)
+        plugin.edtWorkersEdit.text = "1"
+        return
+
+    def start(self):
+        assert self.plugin.beginButtonClicked(), PythonQt.messages
+        begin = self.plugin.beginCoord_arr
+        end = begin + self.plugin.dims_arr
+        region = KnossosModule.knossos.segmentation[tuple([slice(start, stop) for (start, stop) in zip(begin, end)])]
+        (objIds, counts) = numpy.unique(region[region > 0], return_counts=True)
+        self.objId = objIds[numpy.argmax(counts)]
+        seg = KnossosModule.knossos.segmentation
+        self.seeds = [center for center in innerCenters(self.centers, begin, end) if seg[center] == self.objId]
+        return
+
+    def selectObj(self):
+        click(self.plugin, self.seeds[0])
+        return
+
+    def seed(self, count):
+        for coord in self.seeds[:count]:
+            click(self.plugin, coord)
+        return
+
+    def seedIds(self):
+        return sorted(self.plugin.nonSlacks())
+
+    def results(self):
+        (Ids, counts) = numpy.unique(self.plugin.WS_masked, return_counts=True)
+        return objectResults(self.plugin.WS_masked, zip(Ids, counts))
+
+    def close(self):
+        if self.plugin.active:
+            self.plugin.resetButtonClicked()
+        self.plugin.uninitLogic()
+        return
+    pass
@@ -0,0 +1,172 @@
+# Benchmarks of the watershed plugins at several work area sizes. Every round starts from a fresh
+# session, prepared outside of the timing. Timings are saved as JSON under .benchmarks, so that
+# runs can be compared with --benchmark-compare. What the sessions result in is checked against
+# results.json, the results of a reference run (stored again with --update-results)
+import os
+import numpy
+import pytest
+from harness import SegmentorSession, SplitterSession, click
+
+SIZES = [32, 64, 96]
+ROUNDS = 3
+
+def bench(benchmark, sessions, results, newSession, prepare, target):
+    # Every round runs the same, so the last session is checked
+    def setup():
+        session = newSession()
+        sessions.append(session)
+        prepare(session)
+        return ((session,), {})
+    benchmark.pedantic(target, setup=setup, rounds=ROUNDS)
+    results(sessions[-1])
+    return
+
+def begun(seedNum):
+    def prepare(session):
+        session.start()
+        session.seed(seedNum)
+        return
+    return prepare
+
+@pytest.mark.parametrize("size", SIZES)
+def test_segmentor_begin(benchmark, sessions, results, segmentorModule, size):
+    bench(benchmark, sessions, results, lambda: SegmentorSession(segmentorModule, size), lambda session: None, \
+          lambda session: session.start())
+    return
+
+@pytest.mark.parametrize("size", SIZES)
+def test_segmentor_add_seed(benchmark, sessions, results, segmentorModule, size):
+    bench(benchmark, sessions, results, lambda: SegmentorSession(segmentorModule, size), begun(2), \
+          lambda session: click(session.plugin, session.seeds[2]))
+    return
+
+@pytest.mark.parametrize("size", SIZES)
+def test_segmentor_remove_seeds(benchmark, sessions, results, segmentorModule, size):
+    def target(session):
+        Id = session.seedIds()[1]
+        session.plugin.tableClickById(Id)
+        session.plugin.removeSeeds([Id])
+        session.plugin.executor.flush()
+        return
+    bench(benchmark, sessions, results, lambda: SegmentorSession(segmentorModule, size), begun(4), target)
+    return
+
+@pytest.mark.parametrize("size", SIZES)
+def test_segmentor_apply_mask(benchmark, sessions, results, segmentorModule, size):
+    def target(session):
+        session.plugin.curObjId = session.seedIds()[0]
+        session.plugin.applyMask()
+        return
+    bench(benchmark, sessions, results, lambda: SegmentorSession(segmentorModule, size), begun(3), target)
+    return
+
+@pytest.mark.parametrize("size", SIZES)
+def test_segmentor_finish(benchmark, sessions, results, segmentorModule, size):
+    bench(benchmark, sessions, results, lambda: SegmentorSession(segmentorModule, size), begun(4), \
+          lambda session: session.plugin.finishButtonClicked())
+    return
+
+def residentBytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+
+@pytest.mark.parametrize("size", SIZES)
+def test_segmentor_click_memory(benchmark, sessions, results, segmentorModule, size):
+    # Clicks copy what their watershed reads into scratch buffers kept from click to click, so once
+    # these exist a click does not keep as much as a copy of the seeded distances
+    session = SegmentorSession(segmentorModule, size)
+    sessions.append(session)
+    session.start()
+    session.seed(2)
+    scratch = dict(session.plugin.scratch)
+    resident = [residentBytes()]
+    for coord in session.seeds[2:7]:
+        click(session.plugin, coord)
+        resident.append(residentBytes())
+    # The median, as the heap of the process may grow once on any click
+    growth = numpy.median(numpy.diff(resident))
+    results(session)
+    seeds = iter(session.seeds[7:])
+    benchmark.pedantic(lambda: click(session.plugin, next(seeds)), rounds=ROUNDS)
+    benchmark.extra_info["rss_growth_per_click_mb"] = growth / 2.0**20
+    assert set(["jobDist", "jobSeeds", "jobMask"]) <= set(scratch)
+    assert all([session.plugin.scratch[name] is buf for (name, buf) in scratch.items()])
+    assert growth < session.plugin.seededDistMatrix.nbytes
+    return
+
+def anisotropicSession(module, isScaled):
+    # Cells at the voxel scale of the dataset, so flatter along the coarser z, with gaps in their membranes.
+    # Unless isScaled, the segmentor takes voxels as cubes, as it did before following the voxel scale
+    session = SegmentorSession(module, 48, isScaled=True, holeFraction=0.2)
+    if not isScaled:
+        session.plugin.voxelSampling = lambda: (1.0, 1.0, 1.0)
+    return session
+
+def correctiveClicks(session):
+    # Clicks the center of every cell in the work area. A center already in the basin of another cell's seed
+    # only jumps to that basin, and takes another click to split it off
+    clicks = 0
+    for coord in session.seeds:
+        for attempt in xrange(3):
+            if session.plugin.seedMatrix[session.plugin.coordOffset(coord)] <> 0:
+                break
+            click(session.plugin, coord)
+            clicks += 1
+    return clicks - len(session.seeds)
+
+@pytest.mark.parametrize("isScaled", [True, False])
+def test_segmentor_corrective_clicks(benchmark, sessions, results, segmentorModule, isScaled):
+    # Begin is timed either way, to compare the runtime of following the voxel scale. Basins following it
+    # leak through the gaps into fewer neighbouring cells, which then take fewer corrective clicks
+    bench(benchmark, sessions, results, lambda: anisotropicSession(segmentorModule, isScaled), lambda session: None, \
+          lambda session: session.start())
+    clicks = correctiveClicks(sessions[-1])
+    benchmark.extra_info["corrective_clicks"] = clicks
+    if isScaled:
+        reference = anisotropicSession(segmentorModule, False)
+        sessions.append(reference)
+        reference.start()
+        assert clicks < correctiveClicks(reference)
+    return
+
+def selected(seedNum):
+    def prepare(session):
+        session.start()
+        session.selectObj()
+        session.seed(seedNum)
+        return
+    return prepare
+
+@pytest.mark.parametrize("size", SIZES)
+def test_splitter_begin(benchmark, sessions, results, splitterModule, size):
+    bench(benchmark, sessions, results, lambda: SplitterSession(splitterModule, size), lambda session: None, \
+          lambda session: session.start())
+    return
+
+@pytest.mark.parametrize("size", SIZES)
+def test_splitter_apply_mask(benchmark, sessions, results, splitterModule, size):
+    # Selecting the object to split computes its mask
+    bench(benchmark, sessions, results, lambda: SplitterSession(splitterModule, size), lambda session: session.start(), \
+          lambda session: session.selectObj())
+    return
+
+@pytest.mark.parametrize("size", SIZES)
+def test_splitter_add_seed(benchmark, sessions, results, splitterModule, size):
+    bench(benchmark, sessions, results, lambda: SplitterSession(splitterModule, size), selected(2), \
+          lambda session: click(session.plugin, session.seeds[2]))
+    return
+
+@pytest.mark.parametrize("size", SIZES)
+def test_splitter_remove_seeds(benchmark, sessions, results, splitterModule, size):
+    def target(session):
+        session.plugin.removeSeeds([session.seedIds()[1]])
+        session.plugin.executor.flush()
+        return
+    bench(benchmark, sessions, results, lambda: SplitterSession(splitterModule, size), selected(3), target)
+    return
+
+@pytest.mark.parametrize("size", SIZES)
+def test_splitter_finish(benchmark, sessions, results, splitterModule, size):
+    bench(benchmark, sessions, results, lambda: SplitterSession(splitterModule, size), selected(3), \
+          lambda session: session.plugin.finishButtonClicked())
+    return
@@ -0,0 +1,39 @@
+# Results of the optimized paths, each compared with a session computing them the plain way
+import numpy, pytest
+from harness import SegmentorSession
+
+SIZE = 48
+
+def seededWS(module, patch=None, seedNum=6):
+    # WS after seeding and then removing one of the seeds
+    session = SegmentorSession(module, SIZE)
+    if patch is not None:
+        patch(session.plugin)
+    try:
+        session.start()
+        session.seed(seedNum)
+        session.plugin.removeSeeds([session.seedIds()[2]])
+        session.plugin.executor.flush()
+        return session.plugin.WS.copy()
+    finally:
+        session.close()
+
+def fullWsBox(plugin):
+    plugin.wsBox = lambda mask, keptBox: plugin.fullBox()
+    return
+
+def test_segmentor_confined_ws(segmentorModule):
+    assert numpy.array_equal(seededWS(segmentorModule), seededWS(segmentorModule, fullWsBox))
+    return
+
+def previewAt(factor):
+    def patch(plugin):
+        plugin.isPreviewCheckBox.setChecked(True)
+        plugin.previewFactorEdit.text = str(factor)
+        return
+    return patch
+
+@pytest.mark.parametrize("factor", [2, 4])
+def test_segmentor_preview_ws(segmentorModule, factor):
+    assert numpy.array_equal(seededWS(segmentorModule, previewAt(factor), seedNum=12), seededWS(segmentorModule, seedNum=12))
+    return
@@ -1,16 +1,54 @@
 from PythonQt import QtGui, Qt
 import KnossosModule
-import numpy, os, re, string, sys, traceback, time
-import PIL as Image
+import numpy, os, re, string, sys, traceback, time, hashlib, multiprocessing, threading, Queue, json, tempfile, collections, contextlib
+from multiprocessing.pool import ThreadPool
+from PIL import Image
 from scipy import ndimage
 from skimage.morphology import watershed
 from matplotlib import pyplot as plt
 from knossos_utils import knossosdataset, KnossosDataset
 knossosdataset._set_noprint(True)
+try:
+    import resource
+except ImportError:
+    # Not on Windows, where the peak rise of phases is not recorded
+    resource = None
 
 #KNOSSOS_PLUGIN	Version	1
 #KNOSSOS_PLUGIN	Description	Iteratively split a volume into subobjects using a watershed algorithm on a pre-calculated prediction
 
+knossosDatasets = {}
+knossosDatasetsLock = threading.Lock()
+
+def knossosDatasetAt(path):
+    # Datasets are shared process-wide, so knossos.conf is parsed once per path
+    with knossosDatasetsLock:
+        if path not in knossosDatasets:
+            dataset = KnossosDataset.knossosDataset()
+            dataset.initialize_from_knossos_path(path)
+            knossosDatasets[path] = dataset
+        return knossosDatasets[path]
+
+def edtSlab(args):
+    # Pool worker: EDT of a slab cut along axis 0, with the maximal distance of its
+    # core. The core is returned only if exact, i.e. no core voxel is farther from
+    # its nearest background voxel than from a cut face of the slab
+    (crop, coreBegin, coreEnd, isCutBegin, isCutEnd, sampling) = args
+    if crop.all():
+        return (None, numpy.inf)
+    dist = ndimage.distance_transform_edt(crop, sampling=sampling)[coreBegin:coreEnd]
+    pos = numpy.arange(coreBegin, coreEnd)
+    bound = numpy.empty(len(pos))
+    bound.fill(numpy.inf)
+    if isCutBegin:
+        bound = numpy.minimum(bound, (pos + 1)*sampling[0])
+    if isCutEnd:
+        bound = numpy.minimum(bound, (len(crop) - pos)*sampling[0])
+    maxDist = dist.reshape(len(pos), -1).max(1)
+    if (maxDist > bound).any():
+        return (None, maxDist.max())
+    return (dist.astype("float32"), maxDist.max())
+
 class main_class(QtGui.QWidget):
     INSTRUCTION_TEXT_STR = """
 Concept:
@@ -35,8 +73,28 @@ Configuration:
 - Membrane Threshold - membrane prediction values above this denote a barrier, equal/below denote a cell
 - Min Obj Size - when a basin is split, the (voxel) size of both the split-off and the remainder of the
   original basin are checked against this value
-- Auto Slack - whether to compute and seed slack automatically. Erosions - number of iterations for
-  eroding the thresholded membrane prediction before seeding the auto slack
+- Auto Slack - whether to compute and seed slack automatically. Erosions - radius (voxels along the finest axis)
+  of the diamond eroding the thresholded membrane prediction before seeding the auto slack. Steps along an axis
+  count by its voxel scale, so at isotropic scale this is as many erosions by the 6-neighbour cross
+- Cache Dir, Cache MB - directory and size cap of the on-disk cache of the processed membrane prediction.
+  Beginning again on the same work area with the same parameters opens it instead of recomputing.
+  Least recently used entries are evicted beyond the cap. 0 disables the cache
+- EDT Workers - number of processes computing the distance transform of the membrane prediction. Distances
+  and erosions follow the voxel scale of the dataset, so basins are not stretched along its coarser axes.
+  The processes are forked from knossos upon the first Begin that computes it and kept until the plugin is
+  closed, each a copy of the whole knossos process, so a few suffice. 1 computes in knossos itself
+- Compact - hold basin labels as 32 bit instead of 64 bit. Memory use of the work area is shown below the tables
+- Checkpoint Dir, Checkpoint Sec - directory and interval of session checkpoints. 0 disables checkpoints
+- Spill Dir, Spill Buffers - hold the result buffers of the work area (labels, seeds, distances, masks) in memory
+  mapped files in Spill Dir, which the OS may page out while unused. The work area is not tiled: the membrane
+  prediction and its distance transform at Begin, and the watershed of a basin spanning the whole work area
+  (e.g. the initial Auto Slack), are still computed in RAM, so the work area must still fit in memory
+- Prefetch MB - size cap of the membrane prediction cubes kept in memory. While no work area is begun, cubes
+  of the configured work area (plus margin) are read in the background, so that Begin does not wait for them
+- Preview, Preview Factor - when seeding, first show the watershed calculated on the membrane prediction
+  downsampled by Preview Factor (2 or 4), and confine the full resolution watershed that follows to the
+  new basin found by the preview. Where the confined watershed cannot tell the new basin for sure, the whole
+  basin is flooded after all, so results are the same as without Preview. Faster on large basins
 
 Operation
 - In this paragraph you will learn how to operate the plugin technically. Then read Workflow instructions below.
@@ -65,6 +123,15 @@ Operation
   Do not use this feature to merge objects, but only to claim back part of the active basin that was wrongfully
   given to another basin (or the auto-slack) by the watershed
 - Undo the last basin split-off by clicking the Undo Last button
+- To seed basins from existing skeletons, enter blank-separated tree IDs in Tree IDs (or leave it empty for
+  all trees) and click Seed From Trees. Each tree becomes a basin seeded at all of its nodes within the work area
+  (its first such node being the main seed), and a single watershed of all seeds recalculates the entire work
+  area. The new basins are added to the Pending table. Basins smaller than Min Obj Size are reported,
+  but kept
+- The wall time, CPU time and memory of the latest phases (membrane prediction read, distance transform,
+  watershed, mask, write, waiting for the loader) are shown below the tables. Memory is the resident size at the
+  begin and end of a phase, and how much the peak resident size rose during it (n/a where not available).
+  Dump Trace... saves the recent ones to a file, as CSV if its name ends with .csv and as JSON otherwise
 - Change the active basin by clicking the row of another basin in the Pending table. This will update the
   watershed masking in the viewport, and jump to the main seed of the basin (except for the Auto Slack, that
   has no main seed). When the pending table has focus, one can use Up and Down arrow keys to change selection
@@ -80,8 +147,18 @@ Operation
   with an italic font. Toggle slack classification by selecting the 
 - Select a basin row, and click Control+B to mark it as TODO (font becomes bold). Click again to toggle off
 - The cursor shape changes when operations are carried on (watershed / changing position / supercube loading).
-  Wait for the cursor to go back to normal before proceeding in operation
+  Wait for the cursor to go back to normal before proceeding in operation. If the supercube loader is still busy
+  after a minute, the read or write waiting for it is aborted with an error, and may be retried
+- The watershed of a seeding click runs in the background, with a busy arrow cursor meanwhile, and the viewer
+  remains usable. Seeding again before it is done discards the previous click and seeds the new one instead.
+  Any other click, e.g. adding a subseed, first waits for the previous click to be done. Deleting basins refloods
+  their territory in the background likewise, and any click meanwhile waits for it
+- Only knossos cubes whose labels changed are written to the overlay. The voxel count, number of boxes and
+  time of the last write are shown below the tables
 - Press reset at any time to discard your work and go back to normal knossos operation
+- While working, the session is checkpointed every Checkpoint Sec seconds (if anything changed) and upon Reset.
+  Clicking Resume instead of Begin, with the same configuration, continues the checkpointed session without
+  recalculating any watershed. Pending subseeds are not checkpointed. The checkpoint is removed upon Finish
 - Once finished, click Finish to write labels to knossos
 
 Workflow
@@ -111,6 +188,9 @@ Workflow
     SUBOBJECT_COORD_COLUMN_STR = "Coordinate"
     SUBOBJECT_MORE_COORDS_COLUMN_STR = "Subseeds Coordinates"
     OBJECT_LIST_COLUMNS = [SUBOBJECT_ID_COLUMN_STR, SUBOBJECT_COORD_COLUMN_STR, SUBOBJECT_MORE_COORDS_COLUMN_STR]
+    LOADER_POLL_MIN_SEC = 0.001
+    LOADER_POLL_MAX_SEC = 0.05
+    LOADER_TIMEOUT_SEC = 60
 
     class BusyCursorScope:
         def __init__(self):
@@ -124,6 +204,332 @@ Workflow
             return
         pass
 
+    class PhaseTimer:
+        # Wall time, CPU time and resident memory of named phases, the latest records kept in a ring buffer.
+        # Memory is the resident size at the begin and end of a phase, and how much the peak resident size of
+        # the process rose during it. CPU time and memory are of the whole process. Phases may be timed on any thread
+        FIELDS = ["phase", "begin", "wall_sec", "cpu_sec", "rss_begin_mb", "rss_end_mb", "peak_rise_mb"]
+
+        def __init__(self, capacity=10000):
+            self.records = collections.deque(maxlen=capacity)
+            self.latest = collections.OrderedDict()
+            self.lock = threading.Lock()
+            return
+
+        def cpuTime(self):
+            times = os.times()
+            return times[0] + times[1]
+
+        def rssMB(self):
+            # Current resident size, where /proc is available
+            try:
+                with open("/proc/self/statm") as f:
+                    pages = int(f.read().split()[1])
+            except (IOError, IndexError, ValueError):
+                return None
+            return pages*os.sysconf("SC_PAGE_SIZE")/1048576.0
+
+        def maxRssMB(self):
+            if resource is None:
+                return None
+            # Kilobytes on Linux, bytes on macOS
+            maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxRss/(1048576.0 if sys.platform == "darwin" else 1024.0)
+
+        def memoryMB(self, val):
+            if val is None:
+                return "n/a"
+            return "%.1f MB" % val
+
+        @contextlib.contextmanager
+        def phase(self, name):
+            (begin, cpu, rssBegin, maxRssBegin) = (time.time(), self.cpuTime(), self.rssMB(), self.maxRssMB())
+            try:
+                yield
+            finally:
+                (wall, cpu) = (time.time() - begin, self.cpuTime() - cpu)
+                maxRssEnd = self.maxRssMB()
+                peakRise = None if maxRssBegin is None else maxRssEnd - maxRssBegin
+                record = (name, begin, wall, cpu, rssBegin, self.rssMB(), peakRise)
+                with self.lock:
+                    self.records.append(record)
+                    self.latest.pop(name, None)
+                    self.latest[name] = record
+            return
+
+        def timed(self, name, func):
+            def timedFunc(*args):
+                with self.phase(name):
+                    return func(*args)
+            return timedFunc
+
+        def breakdown(self):
+            with self.lock:
+                records = self.latest.values()
+            if len(records) == 0:
+                return ""
+            return "\n".join(["%s: %.3f s (CPU %.3f s), memory %s to %s, peak rise %s" % \
+                              (name, wall, cpu, self.memoryMB(rssBegin), self.memoryMB(rssEnd), self.memoryMB(peakRise)) \
+                              for (name, begin, wall, cpu, rssBegin, rssEnd, peakRise) in records])
+
+        def dump(self, path):
+            with self.lock:
+                records = list(self.records)
+            with open(path, "w") as f:
+                if path.lower().endswith(".csv"):
+                    f.write(",".join(self.FIELDS) + "\n")
+                    for record in records:
+                        f.write(",".join([record[0]] + ["" if val is None else repr(val) for val in record[1:]]) + "\n")
+                else:
+                    json.dump([dict(zip(self.FIELDS, record)) for record in records], f, indent=1)
+            return
+        pass
+
+    class Executor:
+        # Runs jobs on a worker thread. Submitting a job of some kind supersedes any earlier job of
+        # that kind, which is then skipped, or its result dropped. Results are handed to callbacks on
+        # the GUI thread as soon as they are ready: the worker wakes the event loop through a pipe
+        # (where it cannot watch one, a timer polls instead), and flush waits on the results queue
+        def __init__(self, pollInterval=20, isBusyCursor=True):
+            self.isBusyCursor = isBusyCursor
+            self.jobs = Queue.Queue()
+            self.results = Queue.Queue()
+            self.generations = {}
+            self.pendingLock = threading.Lock()
+            self.pending = 0
+            self.isCursorSet = False
+            self.timer = None
+            self.wakeFds = None
+            if os.name == "posix":
+                self.wakeFds = os.pipe()
+                self.notifier = Qt.QSocketNotifier(self.wakeFds[0], Qt.QSocketNotifier.Read)
+                self.notifier.activated.connect(self.wake)
+            else:
+                self.timer = Qt.QTimer()
+                self.timer.timeout.connect(self.poll)
+                self.timer.start(pollInterval)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            return
+
+        def addPending(self, count):
+            with self.pendingLock:
+                self.pending += count
+            return
+
+        def submit(self, kind, func, args, onDone, onError=None):
+            generation = self.generations.get(kind, 0) + 1
+            self.generations[kind] = generation
+            self.addPending(1)
+            if self.isBusyCursor and (not self.isCursorSet):
+                Qt.QApplication.setOverrideCursor(QtGui.QCursor(Qt.Qt.BusyCursor))
+                self.isCursorSet = True
+            self.jobs.put((kind, generation, func, args, onDone, onError))
+            return
+
+        def cancel(self, kind):
+            self.generations[kind] = self.generations.get(kind, 0) + 1
+            return
+
+        def isCurrent(self, kind, generation):
+            return self.generations[kind] == generation
+
+        def run(self):
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                (kind, generation, func, args, onDone, onError) = job
+                if not self.isCurrent(kind, generation):
+                    self.addPending(-1)
+                    continue
+                try:
+                    result = (func(*args), None)
+                except:
+                    result = (None, traceback.format_exc())
+                self.results.put((kind, generation, onDone, onError, result))
+                if self.wakeFds is not None:
+                    os.write(self.wakeFds[1], "r")
+            if self.wakeFds is not None:
+                map(os.close, self.wakeFds)
+            return
+
+        def wake(self, *args):
+            # The pipe is readable, so this does not block
+            os.read(self.wakeFds[0], 4096)
+            self.poll()
+            return
+
+        def poll(self):
+            while True:
+                try:
+                    item = self.results.get_nowait()
+                except Queue.Empty:
+                    break
+                self.handle(item)
+            if self.isCursorSet and (self.pending == 0):
+                Qt.QApplication.restoreOverrideCursor()
+                self.isCursorSet = False
+            return
+
+        def handle(self, item):
+            # Errors of the job, or of its callback, are reported like any other error of the plugin
+            (kind, generation, onDone, onError, (result, exc)) = item
+            self.addPending(-1)
+            if not self.isCurrent(kind, generation):
+                return
+            if exc is None:
+                try:
+                    onDone(result)
+                except:
+                    exc = traceback.format_exc()
+            if exc is None:
+                return
+            if onError is None:
+                QtGui.QMessageBox.information(0, "Error", "Exception caught!\n" + exc)
+            else:
+                onError(exc)
+            return
+
+        def flush(self):
+            # Waits on the results queue, keeping the GUI event loop running meanwhile
+            while self.pending > 0:
+                Qt.QApplication.processEvents()
+                try:
+                    item = self.results.get(timeout=0.01)
+                except Queue.Empty:
+                    continue
+                self.handle(item)
+            self.poll()
+            return
+
+        def call(self, kind, func, args):
+            # Blocks the caller until done, but keeps the GUI event loop running meanwhile
+            outcome = {}
+            self.submit(kind, func, args, lambda result: outcome.update(result=result), lambda exc: outcome.update(exc=exc))
+            self.flush()
+            if "exc" in outcome:
+                raise RuntimeError(outcome["exc"])
+            return outcome["result"]
+
+        def stop(self):
+            # The worker closes the pipe once done, as it may still be writing to it
+            if self.timer is None:
+                self.notifier.setEnabled(False)
+            else:
+                self.timer.stop()
+            self.jobs.put(None)
+            return
+        pass
+
+    class CubePrefetcher:
+        # Bounded LRU of dataset blocks, aligned to knossos cubes. Regions are assembled from cached blocks,
+        # reading missing ones on the spot. A worker thread warms the blocks of the latest prefetched regions
+        def __init__(self, edge, capacityBytes):
+            self.edge = edge
+            self.capacityBytes = capacityBytes
+            self.blocks = collections.OrderedDict()
+            self.cachedBytes = 0
+            self.lock = threading.Lock()
+            self.requests = Queue.Queue()
+            self.generation = 0
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            return
+
+        def blockBegins(self, offset, size):
+            first = (offset // self.edge) * self.edge
+            ranges = [xrange(first[axis], offset[axis] + size[axis], self.edge) for axis in xrange(3)]
+            return [numpy.array((x, y, z)) for x in ranges[0] for y in ranges[1] for z in ranges[2]]
+
+        def block(self, path, begin):
+            key = (path, tuple(begin))
+            with self.lock:
+                if key in self.blocks:
+                    block = self.blocks.pop(key)
+                    self.blocks[key] = block
+                    return block
+            block = knossosDatasetAt(path).from_cubes_to_matrix([self.edge]*3, list(begin), type='raw')
+            with self.lock:
+                if key not in self.blocks:
+                    self.blocks[key] = block
+                    self.cachedBytes += block.nbytes
+                while (self.cachedBytes > self.capacityBytes) and (len(self.blocks) > 0):
+                    self.cachedBytes -= self.blocks.popitem(last=False)[1].nbytes
+            return block
+
+        def read(self, path, offset, size):
+            offset = numpy.array(offset)
+            size = numpy.array(size)
+            matrix = None
+            for begin in self.blockBegins(offset, size):
+                block = self.block(path, begin)
+                if matrix is None:
+                    matrix = numpy.empty(size, dtype=block.dtype)
+                lo = numpy.maximum(begin, offset)
+                hi = numpy.minimum(begin + self.edge, offset + size)
+                matrix[tuple([slice(l, h) for (l, h) in zip(lo - offset, hi - offset)])] = \
+                    block[tuple([slice(l, h) for (l, h) in zip(lo - begin, hi - begin)])]
+            return matrix
+
+        def prefetch(self, path, regions):
+            # Supersedes regions still being prefetched
+            self.generation += 1
+            self.requests.put((self.generation, path, [(numpy.array(offset), numpy.array(size)) for (offset, size) in regions]))
+            return
+
+        def run(self):
+            while True:
+                request = self.requests.get()
+                if request is None:
+                    return
+                (generation, path, regions) = request
+                for (offset, size) in regions:
+                    for begin in self.blockBegins(offset, size):
+                        if generation <> self.generation:
+                            break
+                        try:
+                            self.block(path, begin)
+                        except:
+                            # Best effort, a later read reports the error
+                            break
+            return
+
+        def stop(self):
+            self.requests.put(None)
+            return
+        pass
+
+    class SeedStore:
+        # Seed voxels as an N x 3 array of work area offsets and a parallel array of their IDs,
+        # so that seeds are added and deleted in bulk by single numpy operations
+        def __init__(self, dims):
+            self.dims = tuple(dims)
+            self.offsets = numpy.zeros((0,3), dtype="int64")
+            self.ids = numpy.zeros(0, dtype="uint64")
+            return
+
+        def add(self, offsets, Id):
+            self.offsets = numpy.concatenate([self.offsets, offsets])
+            self.ids = numpy.concatenate([self.ids, numpy.full(len(offsets), Id, dtype="uint64")])
+            return
+
+        def keep(self, isKept):
+            offsets = self.offsets[~isKept]
+            self.offsets = self.offsets[isKept]
+            self.ids = self.ids[isKept]
+            return offsets
+
+        def popIds(self, Ids):
+            return self.keep(numpy.in1d(self.ids, numpy.array(Ids, dtype="uint64"), invert=True))
+
+        def popOffsets(self, offsets):
+            flat = numpy.ravel_multi_index(tuple(offsets.T), self.dims)
+            return self.keep(numpy.in1d(numpy.ravel_multi_index(tuple(self.offsets.T), self.dims), flat, invert=True))
+        pass
+
     class MyTableWidget(QtGui.QTableWidget):
         def __init__(self, delF, sF, ctrlBF, parent=None):
             QtGui.QTableWidget.__init__(self,parent)
@@ -197,6 +603,47 @@ Workflow
         slackLayout.addWidget(QtGui.QLabel("Erosions"))
         self.slackErosionItersEdit = QtGui.QLineEdit()
         slackLayout.addWidget(self.slackErosionItersEdit)
+        cacheLayout = QtGui.QHBoxLayout()
+        configLayout.addLayout(cacheLayout)
+        cacheLayout.addWidget(QtGui.QLabel("Cache Dir"))
+        self.cacheDirEdit = QtGui.QLineEdit()
+        cacheLayout.addWidget(self.cacheDirEdit)
+        cacheLayout.addWidget(QtGui.QLabel("Cache MB"))
+        self.cacheSizeEdit = QtGui.QLineEdit()
+        cacheLayout.addWidget(self.cacheSizeEdit)
+        cacheLayout.addWidget(QtGui.QLabel("EDT Workers"))
+        self.edtWorkersEdit = QtGui.QLineEdit()
+        cacheLayout.addWidget(self.edtWorkersEdit)
+        cacheLayout.addWidget(QtGui.QLabel("Compact"))
+        self.isCompactCheckBox = QtGui.QCheckBox()
+        cacheLayout.addWidget(self.isCompactCheckBox)
+        checkpointLayout = QtGui.QHBoxLayout()
+        configLayout.addLayout(checkpointLayout)
+        checkpointLayout.addWidget(QtGui.QLabel("Checkpoint Dir"))
+        self.checkpointDirEdit = QtGui.QLineEdit()
+        checkpointLayout.addWidget(self.checkpointDirEdit)
+        checkpointLayout.addWidget(QtGui.QLabel("Checkpoint Sec"))
+        self.checkpointSecEdit = QtGui.QLineEdit()
+        checkpointLayout.addWidget(self.checkpointSecEdit)
+        spillLayout = QtGui.QHBoxLayout()
+        configLayout.addLayout(spillLayout)
+        spillLayout.addWidget(QtGui.QLabel("Spill Dir"))
+        self.spillDirEdit = QtGui.QLineEdit()
+        spillLayout.addWidget(self.spillDirEdit)
+        spillLayout.addWidget(QtGui.QLabel("Spill Buffers"))
+        self.isSpillBuffersCheckBox = QtGui.QCheckBox()
+        spillLayout.addWidget(self.isSpillBuffersCheckBox)
+        spillLayout.addWidget(QtGui.QLabel("Prefetch MB"))
+        self.prefetchSizeEdit = QtGui.QLineEdit()
+        spillLayout.addWidget(self.prefetchSizeEdit)
+        previewLayout = QtGui.QHBoxLayout()
+        configLayout.addLayout(previewLayout)
+        previewLayout.addWidget(QtGui.QLabel("Preview"))
+        self.isPreviewCheckBox = QtGui.QCheckBox()
+        previewLayout.addWidget(self.isPreviewCheckBox)
+        previewLayout.addWidget(QtGui.QLabel("Preview Factor"))
+        self.previewFactorEdit = QtGui.QLineEdit()
+        previewLayout.addWidget(self.previewFactorEdit)
         self.isSlackCheckBox.stateChanged.connect(self.isSlackCheckBoxChanged)
         self.isSlackCheckBox.setChecked(False)
         self.isSlackCheckBoxChanged(False)
@@ -205,6 +652,9 @@ Workflow
         self.beginButton = QtGui.QPushButton("Begin")
         self.beginButton.clicked.connect(self.beginButtonClicked)
         opButtonsLayout.addWidget(self.beginButton)
+        self.resumeButton = QtGui.QPushButton("Resume")
+        self.resumeButton.clicked.connect(self.resumeButtonClicked)
+        opButtonsLayout.addWidget(self.resumeButton)
         self.undoButton = QtGui.QPushButton("Reset Subseeds")
         self.undoButton.enabled = False
         self.undoButton.clicked.connect(self.undoButtonClicked)
@@ -227,6 +677,25 @@ Workflow
         tableSplit = QtGui.QSplitter()
         tableSplit.setOrientation(Qt.Qt.Horizontal)
         subObjTableLayout.addWidget(tableSplit)
+        self.memoryLabel = QtGui.QLabel()
+        subObjTableLayout.addWidget(self.memoryLabel)
+        self.writeStatsLabel = QtGui.QLabel()
+        subObjTableLayout.addWidget(self.writeStatsLabel)
+        seedTreesLayout = QtGui.QHBoxLayout()
+        subObjTableLayout.addLayout(seedTreesLayout)
+        seedTreesLayout.addWidget(QtGui.QLabel("Tree IDs"))
+        self.seedTreeIdsEdit = QtGui.QLineEdit()
+        seedTreesLayout.addWidget(self.seedTreeIdsEdit)
+        self.seedTreesButton = QtGui.QPushButton("Seed From Trees")
+        self.seedTreesButton.clicked.connect(self.seedTreesButtonClicked)
+        seedTreesLayout.addWidget(self.seedTreesButton)
+        phasesLayout = QtGui.QHBoxLayout()
+        subObjTableLayout.addLayout(phasesLayout)
+        self.phasesLabel = QtGui.QLabel()
+        phasesLayout.addWidget(self.phasesLabel)
+        self.dumpTraceButton = QtGui.QPushButton("Dump Trace...")
+        self.dumpTraceButton.clicked.connect(self.dumpTraceButtonClicked)
+        phasesLayout.addWidget(self.dumpTraceButton)
         self.pendSubObjTable = self.MyTableWidget(self.pendSubObjTableDel, self.pendSubObjTableS, self.pendSubObjTableCtrlB)
         pendSubObjTableWidget = QtGui.QWidget()
         tableSplit.addWidget(pendSubObjTableWidget)
@@ -283,11 +752,27 @@ Workflow
 
     def loadMembranePrediction(self, path, offset, size):
         # Load membrane prediction
-        membraneDataset = KnossosDataset.knossosDataset()
-        membraneDataset.initialize_from_knossos_path(path)
-        memPred = membraneDataset.from_cubes_to_matrix(size, offset, type='raw')
+        memPred = self.prefetcher.read(path, offset, size)
         return numpy.invert(memPred > self.memThres)
 
+    def prefetchTimerFired(self):
+        # Between sessions, warm the membrane prediction of the configured work area, as Begin reads it
+        if self.active:
+            return
+        try:
+            path = self.validateDir(str(self.dirEdit.text))
+            margin = int(self.marginEdit.text)
+            beginCoord_arr = numpy.array(self.str2tripint(str(self.workAreaBeginEdit.text))) - 1 - margin
+            dims_arr = numpy.array(self.str2tripint(str(self.workAreaSizeEdit.text))) + (2*margin)
+        except:
+            return
+        region = (path, tuple(beginCoord_arr), tuple(dims_arr))
+        if region == self.lastPrefetch:
+            return
+        self.lastPrefetch = region
+        self.prefetcher.prefetch(path, [(beginCoord_arr, dims_arr)])
+        return
+
     def finalizeTable(self, table):
         table.horizontalHeader().setStretchLastSection(True)
         self.resizeTable(table)
@@ -363,6 +848,17 @@ Workflow
                         (self.minObjSizeEdit,"MIN_OBJ_SIZE","500"), \
                        (self.isSlackCheckBox,"IS_SLACK",True), \
                        (self.slackErosionItersEdit,"SLACK_EROSION_ITERS","1"), \
+                       (self.cacheDirEdit,"CACHE_DIR",os.path.join(os.path.expanduser("~"),".knossos_plugins_cache","WatershedCubeSegmentor")), \
+                       (self.cacheSizeEdit,"CACHE_SIZE_MB","4096"), \
+                       (self.isCompactCheckBox,"IS_COMPACT",True), \
+                       (self.edtWorkersEdit,"EDT_WORKERS",str({True:1,False:min(4, multiprocessing.cpu_count())}[os.name == "nt"])), \
+                       (self.checkpointDirEdit,"CHECKPOINT_DIR",os.path.join(os.path.expanduser("~"),".knossos_plugins_checkpoints","WatershedCubeSegmentor")), \
+                       (self.checkpointSecEdit,"CHECKPOINT_SEC","60"), \
+                       (self.spillDirEdit,"SPILL_DIR",os.path.join(os.path.expanduser("~"),".knossos_plugins_spill","WatershedCubeSegmentor")), \
+                       (self.isSpillBuffersCheckBox,"IS_SPILL_BUFFERS",False), \
+                       (self.prefetchSizeEdit,"PREFETCH_SIZE_MB","512"), \
+                       (self.isPreviewCheckBox,"IS_PREVIEW",False), \
+                       (self.previewFactorEdit,"PREVIEW_FACTOR","2"), \
                        (self.workWidgetWidthEdit,"WORK_WIDGET_WIDTH", "600"), \
                        (self.workWidgetHeightEdit,"WORK_WIDGET_HEIGHT", "400"), \
                        (self.confWidgetWidthEdit,"CONF_WIDGET_WIDTH", "0"), \
@@ -372,12 +868,31 @@ Workflow
         self.signalConns = []
         self.signalConns.append((KnossosModule.signalRelay.Signal_EventModel_handleMouseReleaseMiddle, self.handleMouseReleaseMiddle))
         self.signalsConnect()
+        self.phases = self.PhaseTimer()
+        self.executor = self.Executor()
+        self.edtPool = None
+        self.checkpointExecutor = self.Executor(isBusyCursor=False)
+        self.checkpointTimer = Qt.QTimer()
+        self.checkpointTimer.timeout.connect(self.checkpointTimerFired)
+        self.pendingSeed = None
+        self.isRefloodPending = False
+        self.prefetcher = self.CubePrefetcher(KnossosModule.knossos.getCubeEdgeLength(), long(self.prefetchSizeEdit.text)*(2**20))
+        self.lastPrefetch = None
+        self.prefetchTimer = Qt.QTimer()
+        self.prefetchTimer.timeout.connect(self.prefetchTimerFired)
+        self.prefetchTimer.start(1000)
+        self.isBeginning = False
         return
 
     def uninitLogic(self):
         self.generateGuiConfig()
         self.saveConfig()
         self.signalsDisonnect()
+        self.executor.stop()
+        self.stopEdtPool()
+        self.checkpointExecutor.stop()
+        self.prefetchTimer.stop()
+        self.prefetcher.stop()
         KnossosModule.scripting.removePluginInstance(__name__, False)
         return
 
@@ -392,6 +907,9 @@ Workflow
         return
     
     def closeEvent(self,event):
+        if self.isBeginning:
+            event.ignore()
+            return
         if not self.active:
             self.uninitLogic()
             event.accept()
@@ -526,6 +1044,7 @@ Workflow
         return
 
     def selectObjId(self, Id):
+        self.finishPendingSeed()
         if Id <> self.curObjId:
             self.undoButtonClicked()
         self.curObjId = Id
@@ -655,9 +1174,9 @@ Workflow
         if self.noApplyMask:
             return
         busyScope = self.BusyCursorScope()
-        self.WS_mask = (self.WS == self.curObjId)
-        self.WS_masked.fill(0)
-        self.WS_masked[self.WS_mask] = self.WS[self.WS_mask]
+        with self.phases.phase("mask"):
+            numpy.equal(self.WS, self.labelFromId(self.curObjId), out=self.WS_mask)
+            numpy.multiply(self.WS, self.WS_mask, out=self.WS_masked)
         self.writeWS(self.WS_masked)
         return
 
@@ -679,16 +1198,15 @@ Workflow
         self.addNode(coord, self.TreeIdById(self.nextId()), vpId)
         return
 
-    def seedMatrixDelId(self,Id,coordTuples):
-        for coordTuple in coordTuples:
-            coord_offset = coordTuple[1]
-            self.seedMatrix[coord_offset] = 0
+    def seedMatrixDel(self,offsets):
+        self.seedMatrix[tuple(offsets.T)] = 0
+        self.seedsChanged(offsets)
         return
 
-    def seedMatrixSetId(self,coordTuples,Id):
-        for coordTuple in coordTuples:
-            coord_offset = coordTuple[1]
-            self.seedMatrix[coord_offset] = Id
+    def seedMatrixSetId(self,offsets,Id):
+        self.seedMatrix[tuple(offsets.T)] = self.labelFromId(Id)
+        self.seedStore.add(offsets,Id)
+        self.seedsChanged(offsets)
         return
 
     def addNode(self,coord,treeId,vpId):
@@ -697,13 +1215,9 @@ Workflow
         self.setActiveNode()
         return nodeId
 
-    def addSeedGetParentIds(self,coords):
-        parentIds = {}
-        for curCoord in coords:
-            Id = self.WS[curCoord[1]]
-            if (Id <> self.invalidId) and (Id <> self.slackObjId):
-                parentIds[Id] = True
-        return parentIds.keys()
+    def addSeedGetParentIds(self,offsets):
+        Ids = map(self.idFromLabel, numpy.unique(self.WS[tuple(offsets.T)]))
+        return [Id for Id in Ids if (Id <> self.invalidId) and (Id <> self.slackObjId)]
 
     def displayCoord(self,coord):
         return tuple(numpy.array(coord)+1)
@@ -712,22 +1226,56 @@ Workflow
         Id = self.nextId()
         if (self.lastObjId <> self.invalidId) and (self.curObjId == self.invalidId):
             QtGui.QMessageBox.information(0, "Error", "Select seed first!")
-        coordTuples = [(coord, coord_offset)] + self.moreCoords
-        self.seedMatrixSetId(coordTuples,Id)
-        parentIds = self.addSeedGetParentIds(coordTuples)
-        WS_temp = self.calcWS()
-        newObjSize = self.countVal(WS_temp,Id)
+        offsets = numpy.array([coord_offset] + [curCoord[1] for curCoord in self.moreCoords])
+        self.seedMatrixSetId(offsets,Id)
+        parentIds = self.addSeedGetParentIds(offsets)
+        # The mask holds exactly the current object, whose voxels are all within box
+        keptBox = self.labelsBox([self.labelFromId(self.curObjId)])
+        box = self.wsBox(self.WS_mask[keptBox], keptBox)
+        self.pendingSeed = offsets
+        if self.isPreview:
+            confinedBox = self.previewSeed(box, Id)
+            if confinedBox is not None:
+                self.calcConfinedWSAsync(lambda WS_temp: self.addSeedDone(WS_temp, confinedBox, coord, vpId, isSlack, Id, offsets, parentIds, box), confinedBox, box, Id)
+                return
+        self.calcWSAsync(lambda WS_temp: self.addSeedDone(WS_temp, box, coord, vpId, isSlack, Id, offsets, parentIds), box=box)
+        return
+
+    def addSeedDone(self, WS_temp, box, coord, vpId, isSlack, Id, offsets, parentIds, outerBox=None):
+        curLabel = self.labelFromId(self.curObjId)
+        if outerBox is not None:
+            # Confined by the preview. The rest of box stays with the current basin, unless the confined
+            # watershed could not tell the new basin, so that outerBox is flooded after all
+            if WS_temp is None:
+                self.calcWSAsync(lambda WS_temp: self.addSeedDone(WS_temp, outerBox, coord, vpId, isSlack, Id, offsets, parentIds), box=outerBox)
+                return
+            WS_temp[WS_temp == 0] = curLabel
+        self.pendingSeed = None
+        # The mask voxels within box are all of the current object. Seeds outside the mask keep their
+        # labels in WS_temp, so they are cleared to only count what is written
+        numpy.multiply(WS_temp, self.WS_mask[box], out=WS_temp)
+        maskSize = self.labelSizes[curLabel] if outerBox is None else numpy.count_nonzero(self.WS_mask[box])
+        newSizes = self.labelCounts(WS_temp)
+        newSizes[0] -= WS_temp.size - maskSize
+        sizes = newSizes.copy()
+        sizes[curLabel] += self.labelSizes[curLabel] - maskSize
+        newObjSize = sizes[self.labelFromId(Id)]
         if newObjSize < self.minObjSize:
             QtGui.QMessageBox.information(0, "Error", "New object size (%d) too small!" % newObjSize)
-            self.seedMatrixDelId(Id,coordTuples)
+            self.rejectSeed(offsets)
             return
         for parentId in parentIds:
-            parentObjSize = self.countVal(WS_temp,parentId)
+            parentObjSize = sizes[self.labelFromId(parentId)]
             if parentObjSize < self.minObjSize:
                 QtGui.QMessageBox.information(0, "Error", "Parent object (%d) new size (%d) too small!" % (parentId, parentObjSize))
-                self.seedMatrixDelId(Id,coordTuples)
+                self.rejectSeed(offsets)
                 return
-        self.WS[self.WS_mask] = WS_temp[self.WS_mask]
+        numpy.copyto(self.WS[box], WS_temp, casting="unsafe", where=self.WS_mask[box])
+        self.labelSizes[curLabel] -= maskSize
+        self.labelSizes += newSizes
+        self.growLabelBoxes(WS_temp, box)
+        self.markChanged(box)
+        self.isPreviewShown = False
         isDone = False
         self.mapCoordToId[coord] = Id
         self.mapIdToSlack[Id] = isSlack
@@ -749,6 +1297,79 @@ Workflow
         self.applyMask()
         return
 
+    def treeSeedCoords(self, tree):
+        # Nodes of the tree inside the work area, that do not coincide with existing seeds
+        coords = []
+        for node in tree.nodes():
+            coord = tuple(node.coordinate().vector())
+            coord_arr = numpy.array(coord)
+            if (coord_arr < self.knossos_beginCoord_arr).any() or (coord_arr > self.knossos_endCoord_arr).any():
+                continue
+            if (coord in coords) or (self.seedMatrix[self.coordOffset(coord)] <> 0):
+                continue
+            coords.append(coord)
+        return coords
+
+    def seedTreesButtonClicked(self):
+        # One basin per skeleton tree, seeded at all its nodes, all flooded by a single watershed
+        if not self.active:
+            return
+        self.finishPendingSeed()
+        if self.IsMoreCoords():
+            QtGui.QMessageBox.information(0, "Error", "Add or undo the pending additional coordinates first!")
+            return
+        treeIds = map(int, re.findall(r"\d+", str(self.seedTreeIdsEdit.text)))
+        ownTreeIds = self.mapIdToTreeId.values()
+        trees = [tree for tree in KnossosModule.skeleton.trees() \
+                 if (tree.tree_id() not in ownTreeIds) and ((len(treeIds) == 0) or (tree.tree_id() in treeIds))]
+        Id = self.nextId()
+        IdCoords = []
+        offsets = []
+        for tree in trees:
+            coords = self.treeSeedCoords(tree)
+            if len(coords) == 0:
+                continue
+            IdCoords.append((Id, coords))
+            offsets.append(self.coordOffsets(coords))
+            self.seedMatrixSetId(offsets[-1],Id)
+            Id += 1
+        if len(IdCoords) == 0:
+            QtGui.QMessageBox.information(0, "Error", "No tree nodes to seed in work area!")
+            return
+        self.pendingSeed = numpy.concatenate(offsets)
+        self.calcWSAsync(lambda ws: self.seedTreesDone(ws, IdCoords), isSlack=True)
+        return
+
+    def seedTreesDone(self, ws, IdCoords):
+        self.pendingSeed = None
+        self.WS[...] = ws
+        self.markChanged(self.fullBox())
+        vpId = 0
+        isDone = False
+        for (Id, coords) in IdCoords:
+            coord = coords[0]
+            self.mapCoordToId[coord] = Id
+            self.mapIdToSlack[Id] = False
+            self.mapIdToTodo[Id] = False
+            self.mapIdToCoord[Id] = coord
+            self.mapIdToDone[Id] = isDone
+            self.mapIdToNodeId[Id] = self.addNode(coord,self.TreeIdById(Id),vpId)
+            self.mapIdToMoreCoords[Id] = coords[1:]
+            self.pushTableStackId(isDone,Id,atFirst=True)
+        self.undoLastButton.enabled = True
+        self.refreshTable(isDone)
+        self.countLabels()
+        smallIds = [Id for (Id, coords) in IdCoords if self.labelSizes[self.labelFromId(Id)] < self.minObjSize]
+        if len(smallIds) > 0:
+            QtGui.QMessageBox.information(0, "Error", "Objects smaller than Min Obj Size: %s" % smallIds)
+        self.noApplyMask = True
+        if self.lastObjId == self.invalidId:
+            self.clickTop(isDone)
+        self.lastObjId = IdCoords[-1][0]
+        self.noApplyMask = False
+        self.applyMask()
+        return
+
     def refreshTable(self, isDone):
         table = self.tableHash[isDone]["Table"]
         self.clearTable(isDone)
@@ -762,6 +1383,7 @@ Workflow
         return
     
     def removeSeeds(self,Ids):
+        self.finishPendingSeed()
         if len(Ids) == 0:
             return
         self.noApplyMask = True
@@ -770,10 +1392,6 @@ Workflow
             if Id == self.lastObjId:
                 self.undoLastButton.enabled = False
             coord = self.mapIdToCoord[Id]
-            moreCoords = self.mapIdToMoreCoords[Id]
-            coords = [coord] + moreCoords
-            coordTuples = [(curCoord, self.coordOffset(curCoord)) for curCoord in coords]
-            self.seedMatrixDelId(Id,coordTuples)
             del self.mapIdToMoreCoords[Id]
             del self.mapCoordToId[coord]
             del self.mapIdToCoord[Id]
@@ -785,27 +1403,66 @@ Workflow
             del self.mapIdToNodeId[Id]
             del self.mapIdToSlack[Id]
             del self.mapIdToTodo[Id]
-            self.refreshTable(isDone)
-            self.WS_mask = self.newTrueMatrix()
-            self.WS = self.calcWS()
-            parentId = self.WS[self.coordOffset(coord)]
-            if self.IsInvalidId(parentId):
-                Id = self.invalidId
-                self.lastObjId = Id
-                self.selectObjId(Id)
-            else:
-                if self.mapIdToDone[parentId]:
-                    self.tableDoubleClickById(parentId)
-                    return
-                self.pushTableStackId(isDone,parentId)
-            self.refreshTable(isDone)
-            self.clickTopOrOtherTop(isDone)
+        self.seedMatrixDel(self.seedStore.popIds(Ids))
+        self.refreshTables()
+        self.refloodTerritory(Ids, lambda: self.removeSeedsDone(coord, isDone))
+        return
+
+    def removeSeedsDone(self, coord, isDone):
+        parentId = self.idFromLabel(self.WS[self.coordOffset(coord)])
+        if self.IsInvalidId(parentId):
+            Id = self.invalidId
+            self.lastObjId = Id
+            self.selectObjId(Id)
+        else:
+            if self.mapIdToDone[parentId]:
+                self.tableDoubleClickById(parentId)
+                return
+            self.pushTableStackId(isDone,parentId)
+        self.refreshTable(isDone)
+        self.clickTopOrOtherTop(isDone)
         self.noJump = False
         self.jumpToCoord(coord)
         self.noApplyMask = False
         self.applyMask()
         return
 
+    def refloodTerritory(self, Ids, onDone):
+        # The labels of all other basins are kept, so removed basins are undone by flooding only their
+        # former territory from the labels bordering it. The watershed runs on the executor thread,
+        # and clicks meanwhile wait for it, as for the watershed of a seed
+        labels = map(self.labelFromId, Ids)
+        keptBox = self.labelsBox(labels)
+        box = self.wsBox(numpy.in1d(self.WS[keptBox], labels).reshape(self.WS[keptBox].shape), keptBox)
+        self.isRefloodPending = True
+        args = (self.snapshotMatrix("jobWS", self.WS[box]), self.snapshotMatrix("jobDist", self.seededDistMatrix[box]), labels)
+        self.executor.submit("reflood", self.calcReflood, args, lambda result: self.refloodDone(result, box, labels, onDone))
+        return
+
+    def calcReflood(self, WS, dist, labels):
+        # Runs on the executor thread
+        territory = numpy.in1d(WS, labels).reshape(WS.shape)
+        border = ndimage.binary_dilation(territory)
+        border[territory] = False
+        markers = self.newValMatrix(0, dims=territory.shape, dtype=WS.dtype)
+        markers[border] = WS[border]
+        with self.phases.phase("watershed"):
+            ws = watershed(dist, markers, None, None, territory)
+        return (territory, ws)
+
+    def refloodDone(self, result, box, labels, onDone):
+        self.isRefloodPending = False
+        (territory, ws) = result
+        self.labelSizes -= self.labelCounts(self.WS[box][territory])
+        self.WS[box][territory] = ws[territory]
+        self.labelSizes += self.labelCounts(ws[territory])
+        for label in labels:
+            self.labelBoxes.pop(label, None)
+        self.growLabelBoxes(ws, box)
+        self.markChanged(box)
+        onDone()
+        return
+
     def tableDel(self,isDone):
         table = self.tableHash[isDone]["Table"]
         rows = self.getTableSelectedRow(table)
@@ -898,10 +1555,27 @@ Workflow
         return
 
     def waitForLoader(self):
+        # Polls at a growing interval while pumping events, instead of spinning. After a timeout, raises
+        # rather than reading or writing a region the loader may still be working on
+        loader = KnossosModule.knossos_global_loader
+        if loader.isFinished():
+            return
         busyScope = self.BusyCursorScope()
-        while not KnossosModule.knossos_global_loader.isFinished():
-            Qt.QApplication.processEvents()
-            time.sleep(0)
+        with self.phases.phase("loader"):
+            begin = time.time()
+            interval = self.LOADER_POLL_MIN_SEC
+            while not loader.isFinished():
+                waited = time.time() - begin
+                if waited > self.LOADER_TIMEOUT_SEC:
+                    msg = "Loader still busy after %d s, aborted" % waited
+                    self.phasesLabel.text = msg
+                    QtGui.QMessageBox.information(0, "Error", msg)
+                    raise RuntimeError(msg)
+                if waited > 1:
+                    self.phasesLabel.text = "Waiting for loader: %d s" % waited
+                Qt.QApplication.processEvents()
+                time.sleep(interval)
+                interval = min(2*interval, self.LOADER_POLL_MAX_SEC)
         return
 
     def setPositionWrap(self, coord):
@@ -915,21 +1589,229 @@ Workflow
             self.jumpToCoord(coord)
         return
 
+    def coordOffsets(self,coords):
+        return numpy.array(coords, dtype="int64").reshape(-1,3) - self.beginCoord_arr
+
     def coordOffset(self,coord):
         return tuple(self.margin + numpy.array(coord) - self.knossos_beginCoord_arr)
 
-    def calcWS(self,isSlack=False):
+    def fullBox(self):
+        return (slice(None),)*3
+
+    def boxStarts(self, box):
+        return [sl.indices(dim)[0] for (sl, dim) in zip(box, self.dims_arr)]
+
+    def wsBox(self, mask, keptBox):
+        # Watershed is confined to mask, the part of the volume at keptBox, so only its bounding box (plus a
+        # margin reaching the neighbouring seeds, clipped to the volume) can change
+        objs = ndimage.find_objects(mask.view(numpy.uint8))
+        if len(objs) == 0:
+            return self.fullBox()
+        return tuple([slice(max(keptStart + sl.start - self.wsBoxMargin, 0), min(keptStart + sl.stop + self.wsBoxMargin, dim)) \
+                      for (sl, keptStart, dim) in zip(objs[0], self.boxStarts(keptBox), self.dims_arr)])
+
+    def labelsBox(self, labels):
+        # Box holding all voxels of labels, from the kept label boxes, so that clicks do not search the full volume
+        boxes = [self.labelBoxes.get(label) for label in labels]
+        if (len(boxes) == 0) or (None in boxes):
+            return self.fullBox()
+        return tuple([slice(min([sl.start for sl in sls]), max([sl.stop for sl in sls])) for sls in zip(*boxes)])
+
+    def growLabelBoxes(self, labels, box):
+        # Grows the kept label boxes to cover labels, the part of WS at box. Boxes of shrunk
+        # labels are not tightened, they only need to hold all voxels of their label
+        starts = self.boxStarts(box)
+        for (label, objBox) in enumerate(ndimage.find_objects(labels), 1):
+            if objBox is None:
+                continue
+            bounds = [(start + sl.start, start + sl.stop) for (sl, start) in zip(objBox, starts)]
+            if label in self.labelBoxes:
+                bounds = [(min(lo, sl.start), max(hi, sl.stop)) for ((lo, hi), sl) in zip(bounds, self.labelBoxes[label])]
+            self.labelBoxes[label] = tuple([slice(lo, hi) for (lo, hi) in bounds])
+        return
+
+    def seededDistAt(self, coords):
+        seeded = self.seedMatrix[coords] > 0
+        return self.distMemPred[coords] - seeded*1.0
+
+    def seedsChanged(self, offsets):
+        coords = tuple(offsets.T)
+        self.seededDistMatrix[coords] = self.seededDistAt(coords)
+        chunk = self.checkpointChunk
+        self.changedChunks.update((numpy.unique(offsets[:, 0]) / chunk * chunk).tolist())
+        return
+
+    def markChanged(self, box):
+        # Chunks of WS and seeds changed since the last checkpoint, which only snapshots those
+        (begin, end) = box[0].indices(int(self.dims_arr[0]))[:2]
+        chunk = self.checkpointChunk
+        self.changedChunks.update(xrange(begin - begin % chunk, end, chunk))
+        return
+
+    def beginSeededDist(self):
+        # Kept up to date seed by seed, so that clicks do not rebuild it
+        self.seededDistMatrix = self.newMatrix(dtype="float32", isSpill=True)
+        self.seededDistMatrix[...] = self.distMemPred
+        coords = numpy.nonzero(self.seedMatrix)
+        self.seededDistMatrix[coords] = self.seededDistAt(coords)
+        return
+
+    def beginPyramid(self):
+        # Downsampled by 2 and 4, taking block maxima so that thin barriers survive
+        self.distPyramid = {}
+        self.isPreviewShown = False
+        if not self.isPreview:
+            return
+        level = self.distMemPred
+        for factor in [2, 4]:
+            level = self.downsample(level, 2)
+            self.distPyramid[factor] = level
+        return
+
+    def downsample(self, matrix, factor):
+        pad = [(0, (-dim) % factor) for dim in matrix.shape]
+        if numpy.any(pad):
+            matrix = numpy.pad(matrix, pad, mode="edge")
+        (x, y, z) = [dim / factor for dim in matrix.shape]
+        return matrix.reshape(x, factor, y, factor, z, factor).max(axis=(1,3,5))
+
+    def previewSeed(self, box, Id):
+        # Watershed of box at the preview factor, shown right away. Returns the box of the new basin in the
+        # preview, grown by a downsampled voxel, to confine the full resolution watershed to. None if it is not
+        # confined, as the new basin is too small in the preview
+        factor = self.previewFactor
+        bounds = [sl.indices(dim)[:2] for (sl, dim) in zip(box, self.dims_arr)]
+        alignedBox = tuple([slice(start - start % factor, stop) for (start, stop) in bounds])
+        coarseStarts = [start / factor for (start, stop) in bounds]
+        coarseBox = tuple([slice(start / factor, -(-stop / factor)) for (start, stop) in bounds])
+        with self.phases.phase("preview"):
+            coarse = watershed(self.distPyramid[factor][coarseBox], self.downsample(self.seedMatrix[alignedBox], factor), \
+                               None, None, self.downsample(self.WS_mask[alignedBox], factor))
+        preview = coarse.repeat(factor, 0).repeat(factor, 1).repeat(factor, 2)
+        preview = preview[tuple([slice(start % factor, start % factor + stop - start) for (start, stop) in bounds])]
+        shown = self.WS_masked[box].copy()
+        numpy.copyto(self.WS_masked[box], preview, casting="unsafe", where=self.WS_mask[box])
+        self.writeWS(self.WS_masked)
+        self.WS_masked[box] = shown
+        self.isPreviewShown = True
+        # A new basin too small in the preview may just have lost its narrow passages to downsampling
+        newBasin = numpy.equal(coarse, self.labelFromId(Id))
+        if numpy.count_nonzero(newBasin)*(factor**3) < self.minObjSize:
+            return None
+        objs = ndimage.find_objects(newBasin.view(numpy.uint8))
+        return tuple([slice(max(start, (coarseStart + sl.start - 1)*factor - self.wsBoxMargin), \
+                            min(stop, (coarseStart + sl.stop + 1)*factor + self.wsBoxMargin)) \
+                      for (sl, coarseStart, (start, stop)) in zip(objs[0], coarseStarts, bounds)])
+
+    def innerFaces(self, box, outerBox):
+        # The faces of box that lie inside outerBox
+        faces = numpy.zeros([sl.stop - sl.start for sl in box], dtype="bool")
+        for (axis, sl, outerSl) in zip(xrange(3), box, outerBox):
+            ends = [0]*int(sl.start > outerSl.start) + [-1]*int(sl.stop < outerSl.stop)
+            faces[(slice(None),)*axis + (ends,)] = True
+        return faces
+
+    def calcConfinedWS(self, dist, seedMatrix, mask, faces, curLabel, newLabel):
+        # Watershed of box, with the current basin flooding in through faces from outside box. Without
+        # seeds on faces, the current basin arrives there too late, and the new basin gets at least its
+        # size in outerBox. With the current basin seeded on faces, it arrives too early, and the new basin
+        # gets at most that. Where both agree and the new basin stays off faces, it is exact. Otherwise None
+        ws = watershed(dist, seedMatrix, None, None, mask)
+        newBasin = numpy.equal(ws, newLabel)
+        if newBasin[faces].any():
+            return None
+        seedMatrix[faces & mask & (seedMatrix == 0)] = curLabel
+        if not numpy.array_equal(numpy.equal(watershed(dist, seedMatrix, None, None, mask), newLabel), newBasin):
+            return None
+        return ws
+
+    def hidePreview(self):
+        if not self.isPreviewShown:
+            return
+        self.isPreviewShown = False
+        self.writeWS(self.WS_masked)
+        return
+
+    def scratchMatrix(self, name, dims, dtype):
+        # Buffers reused across clicks, only grown when a larger one is requested
+        size = numpy.prod(dims)
+        matrix = self.scratch.get(name)
+        if (matrix is None) or (matrix.size < size) or (matrix.dtype <> numpy.dtype(dtype)):
+            matrix = self.newMatrix(dims=(size,), dtype=dtype, isSpill=True)
+            self.scratch[name] = matrix
+        return matrix[:size].reshape(dims)
+
+    def calcWS(self,isSlack=False,box=None):
         busyScope = self.BusyCursorScope()
-        seededDist = self.distMemPred-((self.seedMatrix > 0)*1.0)
+        if box is None:
+            box = self.fullBox()
+        seedMatrix = self.seedMatrix[box]
         if isSlack:
-            mask = self.newTrueMatrix()
+            mask = self.scratchMatrix("trueMask", seedMatrix.shape, "bool")
+            mask.fill(True)
         else:
-            mask = self.WS_mask
-        ws = watershed(seededDist, self.seedMatrix, None, None, mask)
+            mask = self.WS_mask[box]
+        with self.phases.phase("watershed"):
+            ws = watershed(self.seededDistMatrix[box], seedMatrix, None, None, mask)
         return ws
+
+    def calcWSAsync(self,onDone,isSlack=False,box=None):
+        # As calcWS, but on the executor thread. A newer submission supersedes this one.
+        # The job gets snapshots, as the GUI thread goes on changing seeds and mask meanwhile
+        if box is None:
+            box = self.fullBox()
+        seedMatrix = self.snapshotMatrix("jobSeeds", self.seedMatrix[box])
+        if isSlack:
+            mask = self.scratchMatrix("jobMask", seedMatrix.shape, "bool")
+            mask.fill(True)
+        else:
+            mask = self.snapshotMatrix("jobMask", self.WS_mask[box])
+        self.executor.submit("ws", self.phases.timed("watershed", watershed), (self.snapshotMatrix("jobDist", self.seededDistMatrix[box]), seedMatrix, None, None, mask), onDone)
+        return
+
+    def calcConfinedWSAsync(self, onDone, box, outerBox, Id):
+        # As calcWSAsync, for a box confined by the preview within outerBox. Passes None to onDone if the
+        # new basin cannot be told within box
+        seedMatrix = self.snapshotMatrix("jobSeeds", self.seedMatrix[box])
+        mask = self.snapshotMatrix("jobMask", self.WS_mask[box])
+        args = (self.snapshotMatrix("jobDist", self.seededDistMatrix[box]), seedMatrix, mask, self.innerFaces(box, outerBox), \
+                self.labelFromId(self.curObjId), self.labelFromId(Id))
+        self.executor.submit("ws", self.phases.timed("watershed", self.calcConfinedWS), args, onDone)
+        return
+
+    def cancelPendingSeed(self):
+        # Roll back the seeds of a click whose watershed was not yet applied. A pending reflood is
+        # let finish, as the click is based on its result
+        if self.isRefloodPending:
+            self.executor.flush()
+        if self.pendingSeed is None:
+            return
+        offsets = self.pendingSeed
+        self.pendingSeed = None
+        self.executor.cancel("ws")
+        self.rejectSeed(offsets)
+        return
+
+    def rejectSeed(self, offsets):
+        self.seedMatrixDel(self.seedStore.popOffsets(offsets))
+        self.hidePreview()
+        return
+
+    def finishPendingSeed(self):
+        if (self.pendingSeed is None) and (not self.isRefloodPending):
+            return
+        self.executor.flush()
+        return
     
-    def countVal(self,matrix,val):
-        return numpy.sum(matrix==val)
+    def labelCounts(self,labels):
+        return numpy.bincount(labels.ravel(), minlength=len(self.labelToId)).astype("int64")
+
+    def countLabels(self):
+        # Voxel count and bounding box per label of WS, kept up to date by every change of WS
+        self.labelSizes = self.labelCounts(self.WS)
+        self.labelBoxes = {}
+        self.growLabelBoxes(self.WS, self.fullBox())
+        return
 
     def isEmpty(self):
         return len(self.mapCoordToId) == 0
@@ -939,7 +1821,13 @@ Workflow
             return
         coord = tuple(clickedCoord.vector())
         coord_offset = self.coordOffset(coord)
-        seedId = self.seedMatrix[coord_offset]
+        mods = event.modifiers()
+        # Only a click placing a seed of its own supersedes a pending one, any other first lets it finish
+        if self.isSeedingClick(coord_offset, mods):
+            self.cancelPendingSeed()
+        else:
+            self.finishPendingSeed()
+        seedId = self.idFromLabel(self.seedMatrix[coord_offset])
         if seedId <> 0:
             if seedId == self.slackObjId:
                 idStr = "slack"
@@ -947,24 +1835,19 @@ Workflow
                 idStr = "ID " + str(seedId)
             QtGui.QMessageBox.information(0, "Error", "Already contains seed for %s!\n" % idStr)
             return
-        mods = event.modifiers()
         if self.WS_mask[coord_offset] == False:
             if mods <> Qt.Qt.AltModifier:
-                self.jumpToId(self.WS[coord_offset])
+                self.jumpToId(self.idFromLabel(self.WS[coord_offset]))
                 return
             # Extend current object
             Id = self.curObjId
             if not self.IsNormalId(Id):
                 QtGui.QMessageBox.information(0, "Error", "Can only extend a non-auto-slack object!\n")
                 return
-            self.seedMatrix[coord_offset] = Id
-            self.addNode(coord, self.TreeIdById(Id), vpId)
-            self.mapIdToMoreCoords[Id].append(coord)
-            isDone = False
-            self.refreshTable(isDone)
-            self.WS_mask = self.newTrueMatrix()
-            self.WS = self.calcWS()
-            self.applyMask()
+            offsets = numpy.array([coord_offset])
+            self.seedMatrixSetId(offsets,Id)
+            self.pendingSeed = offsets
+            self.calcWSAsync(lambda ws: self.extendSeedDone(ws, coord, vpId, Id), isSlack=True)
             return
         if mods == 0:
             self.addSeed(coord,coord_offset,vpId)
@@ -974,7 +1857,27 @@ Workflow
             self.addSeed(coord,coord_offset,vpId,isSlack=True)
         return
 
+    def isSeedingClick(self, coord_offset, mods):
+        if self.seedMatrix[coord_offset] <> 0:
+            return False
+        if self.WS_mask[coord_offset] == False:
+            return (mods == Qt.Qt.AltModifier) and self.IsNormalId(self.curObjId)
+        return mods in [0, Qt.Qt.ControlModifier]
+
+    def extendSeedDone(self, ws, coord, vpId, Id):
+        self.pendingSeed = None
+        self.addNode(coord, self.TreeIdById(Id), vpId)
+        self.mapIdToMoreCoords[Id].append(coord)
+        isDone = False
+        self.refreshTable(isDone)
+        self.WS[...] = ws
+        self.markChanged(self.fullBox())
+        self.countLabels()
+        self.applyMask()
+        return
+
     def undoButtonClicked(self):
+        self.finishPendingSeed()
         if not self.IsMoreCoords():
             return
         KnossosModule.skeleton.delete_tree(self.mapIdToTreeId.pop(self.nextId()))
@@ -1010,32 +1913,114 @@ Workflow
 
     def accessMatrix(self, matrix, isWrite):
         self.waitForLoader()
-        return KnossosModule.knossos.processRegionByStridedBufProxy(list(self.knossos_beginCoord_arr), list(self.knossos_dims_arr), self.npDataPtr(matrix), matrix.strides, isWrite, True)
+        return self.accessRegion(matrix, isWrite, (0,0,0))
+
+    def accessRegion(self, matrix, isWrite, offset):
+        # matrix may be a view into a work area matrix, beginning at offset within the work area
+        return KnossosModule.knossos.processRegionByStridedBufProxy(list(self.knossos_beginCoord_arr + offset), list(matrix.shape), self.npDataPtr(matrix), matrix.strides, isWrite, True)
 
     def writeMatrix(self, matrix):
         self.accessMatrix(matrix, True)
         return
 
     def matrixNoMargin(self,matrix):
-        return matrix[self.margin:-self.margin,self.margin:-self.margin,self.margin:-self.margin]
-
-    def writeWS(self, matrix):
-        self.writeMatrix(self.matrixNoMargin(matrix))
-
-    def newMatrix(self,dims=None,dtype=None):
-        if dims == None:
+        return matrix[tuple([slice(self.margin, self.margin + dim) for dim in self.knossos_dims_arr])]
+
+    def labelFromId(self, Id):
+        if Id not in self.idToLabel:
+            self.idToLabel[Id] = len(self.labelToId)
+            self.labelToId = numpy.append(self.labelToId, numpy.uint64(Id))
+            self.labelSizes = numpy.append(self.labelSizes, 0)
+        return self.idToLabel[Id]
+
+    def idFromLabel(self, label):
+        return long(self.labelToId[label])
+
+    def writeWS(self, matrix, lut=None):
+        # Basins are labelled compactly, knossos only gets to see their IDs, as mapped by lut.
+        # Only knossos cubes with labels changed since the last write are written. A lut other
+        # than labelToId relabels in the same single pass, so all cubes are written
+        t = time.time()
+        labels = self.matrixNoMargin(matrix)
+        isLabelToId = lut is None
+        if isLabelToId:
+            lut = self.labelToId
+        if self.isWrittenLabels and isLabelToId:
+            dirty = numpy.not_equal(labels, self.writtenLabels, out=self.scratchMatrix("dirty", labels.shape, "bool"))
+            boxes = self.dirtyBoxes(dirty)
+        else:
+            boxes = [tuple([slice(0, dim) for dim in self.knossos_dims_arr])]
+        self.waitForLoader()
+        voxelCount = 0
+        with self.phases.phase("write"):
+            for box in boxes:
+                numpy.take(lut, labels[box], out=self.writeBuffer[box], mode="clip")
+                self.writtenLabels[box] = labels[box]
+                self.accessRegion(self.writeBuffer[box], True, numpy.array([s.start for s in box]))
+                voxelCount += self.writeBuffer[box].size
+        self.isWrittenLabels = isLabelToId
+        self.wsWriteCount += 1
+        self.writeStatsLabel.text = "Last write: %d voxels in %d boxes, %.3f s" % (voxelCount, len(boxes), time.time() - t)
+        self.phasesLabel.text = self.phases.breakdown()
+        return
+
+    def dumpTraceButtonClicked(self):
+        path = str(QtGui.QFileDialog.getSaveFileName(0, "Dump Trace", "", "JSON (*.json);;CSV (*.csv)"))
+        if path == "":
+            return
+        self.phases.dump(path)
+        return
+
+    def dirtyBoxes(self, dirty):
+        # Boxes covering the dirty voxels, made of whole knossos cubes (clipped to the work area).
+        # Dirty cubes that are adjacent along x are merged into a single box
+        edge = KnossosModule.knossos.getCubeEdgeLength()
+        starts = []
+        ends = []
+        cubes = dirty
+        for axis in xrange(3):
+            axisStarts = numpy.arange(-(self.knossos_beginCoord_arr[axis] % edge), dirty.shape[axis], edge)
+            axisStarts[0] = 0
+            starts.append(axisStarts)
+            ends.append(numpy.append(axisStarts[1:], dirty.shape[axis]))
+            cubes = numpy.logical_or.reduceat(cubes, axisStarts, axis=axis)
+        boxes = []
+        for (y, z) in zip(*numpy.nonzero(cubes.any(0))):
+            xs = numpy.flatnonzero(cubes[:,y,z])
+            for run in numpy.split(xs, numpy.flatnonzero(numpy.diff(xs) > 1) + 1):
+                boxes.append((slice(starts[0][run[0]], ends[0][run[-1]]), slice(starts[1][y], ends[1][y]), slice(starts[2][z], ends[2][z])))
+        return boxes
+
+    def newMatrix(self,dims=None,dtype=None,isSpill=False):
+        if dims is None:
             dims = self.dims_arr
-        if dtype == None:
+        if dtype is None:
             dtype = "uint64"
+        if isSpill and self.isSpillBuffers:
+            return self.newSpillMatrix(dims,dtype)
         return numpy.ndarray(shape=dims, dtype=dtype)
 
-    def newValMatrix(self, val, dtype=None):
-        matrix = self.newMatrix(dtype=dtype)
+    def newSpillMatrix(self,dims,dtype):
+        # Memory map of an anonymous file in the spill directory. The OS keeps the parts in use resident and
+        # may page the rest out. This only spills buffers, computations on them are still held in RAM.
+        # The file is gone once the matrix is freed
+        f = tempfile.TemporaryFile(dir=self.spillDir)
+        return numpy.memmap(f, dtype=dtype, mode="w+", shape=tuple(dims))
+
+    def newValMatrix(self, val, dtype=None, dims=None, isSpill=False):
+        matrix = self.newMatrix(dims=dims,dtype=dtype,isSpill=isSpill)
         matrix.fill(val)
         return matrix
 
-    def newTrueMatrix(self):
-        return self.newValMatrix(True,dtype="bool")
+    def newTrueMatrix(self, isSpill=False):
+        return self.newValMatrix(True,dtype="bool",isSpill=isSpill)
+
+    def snapshotMatrix(self, name, matrix):
+        # Copy of matrix for a job, in a scratch buffer reused by the next jobs. Jobs only overlap when a newer
+        # one supersedes a running one, whose result is then dropped anyway
+        snapshot = self.scratchMatrix(name, matrix.shape, matrix.dtype)
+        snapshot[...] = matrix
+        return snapshot
 
     def readMatrix(self, matrix):
         self.accessMatrix(matrix, False)
@@ -1043,6 +2028,8 @@ Workflow
 
     def commonEnd(self):
         self.active = False
+        self.checkpointTimer.stop()
+        self.lastPrefetch = None
         map(self.clearTable,[False,True])
         for treeId in self.mapIdToTreeId.values():
             KnossosModule.skeleton.delete_tree(treeId)
@@ -1057,6 +2044,7 @@ Workflow
         self.widgetLayout.addWidget(self.subObjTableGroupBox)
         self.subObjTableGroupBox.show()
         self.beginButton.enabled = False
+        self.resumeButton.enabled = False
         self.resetButton.enabled = True
         self.finishButton.enabled = True
         self.undoButton.enabled = False
@@ -1073,6 +2061,7 @@ Workflow
         self.widgetLayout.removeWidget(self.subObjTableGroupBox)
         self.subObjTableGroupBox.hide()
         self.beginButton.enabled = True
+        self.resumeButton.enabled = True
         self.undoButton.enabled = False
         self.undoLastButton.enabled = False
         self.resetButton.enabled = False
@@ -1082,57 +2071,241 @@ Workflow
         return
 
     def scaleMatrix(self,m,minVal,maxVal):
+        # In place, sparing a work area sized temporary per operation
         curMinVal = m.min()
         curRange = m.max() - curMinVal
         newRange = maxVal - minVal
-        return ((m - curMinVal)*(newRange/curRange))+minVal
+        m -= curMinVal
+        m *= newRange/curRange
+        m += minVal
+        return m
+
+    def startEdtPool(self):
+        # Forked from the GUI thread, and kept for later Begins with the same worker count. Each worker is
+        # a fork of the whole knossos process, so only a few are started
+        if (self.edtPool is not None) and (self.edtPoolSize == self.edtWorkers):
+            return
+        self.stopEdtPool()
+        if self.edtWorkers > 1:
+            self.edtPool = multiprocessing.Pool(self.edtWorkers)
+            self.edtPoolSize = self.edtWorkers
+        return
 
-    def beginMatrices(self):
-        self.noApplyMask = False
-        self.orig = self.newMatrix(dims=self.knossos_dims_arr)
-        self.readMatrix(self.orig)
-        self.WS = self.newValMatrix(self.invalidId)
-        self.WS_mask = self.newTrueMatrix()
-        self.WS_masked = self.newValMatrix(self.invalidId)
-        self.memPred = self.loadMembranePrediction(self.validateDir(str(self.dirEdit.text)), self.beginCoord_arr, self.dims_arr)
+    def stopEdtPool(self):
+        if self.edtPool is None:
+            return
+        self.edtPool.terminate()
+        self.edtPool.join()
+        self.edtPool = None
+        return
+
+    def tiledEDT(self, binary, sampling=None):
+        # Exact float32 EDT, computed on slabs along axis 0, in the EDT pool if started. A slab is cropped with
+        # a halo, and redone with a halo reaching its maximal distance if that was not exact. Only the crops
+        # are held as float64
+        if sampling is None:
+            sampling = (1.0,)*binary.ndim
+        if binary.all():
+            return ndimage.distance_transform_edt(binary, sampling=sampling).astype("float32")
+        n = binary.shape[0]
+        slabNum = max(n / self.edtSlab, 1)
+        dist = self.newMatrix(dims=binary.shape, dtype="float32", isSpill=True)
+        edges = numpy.linspace(0, n, slabNum + 1).astype(int)
+        pending = [(begin, end, self.edtSlab / 2) for (begin, end) in zip(edges[:-1], edges[1:])]
+        mapper = map
+        if self.edtPool is not None:
+            mapper = self.edtPool.map
+        while len(pending) > 0:
+            jobs = []
+            for (begin, end, halo) in pending:
+                cropBegin, cropEnd = max(begin - halo, 0), min(end + halo, n)
+                jobs.append((binary[cropBegin:cropEnd], begin - cropBegin, end - cropBegin, cropBegin > 0, cropEnd < n, sampling))
+            retry = []
+            for ((begin, end, halo), (slab, maxDist)) in zip(pending, mapper(edtSlab, jobs)):
+                if slab is not None:
+                    dist[begin:end] = slab
+                elif numpy.isinf(maxDist):
+                    retry.append((begin, end, 2*halo))
+                else:
+                    retry.append((begin, end, max(2*halo, int(numpy.ceil(maxDist/sampling[0])) + 1)))
+            pending = retry
+        return dist
+
+    def calcMatrices(self, path):
+        # Runs on the executor thread, so it only reads what beginCommon parsed
+        with self.phases.phase("read"):
+            memPred = self.loadMembranePrediction(path, self.beginCoord_arr, self.dims_arr)
         pad = 1
-        self.memPred = numpy.pad(self.memPred,((pad,pad),)*3,'constant',constant_values=((0,0),)*3)
-        self.distMemPred = -ndimage.distance_transform_edt(self.memPred)
+        memPred = numpy.pad(memPred,((pad,pad),)*3,'constant',constant_values=((0,0),)*3)
+        with self.phases.phase("edt"):
+            distMemPred = self.tiledEDT(memPred, self.sampling)
+            numpy.negative(distMemPred, out=distMemPred)
+            if self.isSlack:
+                distMemPred -= self.tiledEDT(numpy.invert(memPred), self.sampling)
         if self.isSlack:
-            self.distMemPred += -ndimage.distance_transform_edt(numpy.invert(self.memPred))
             if self.slackErosionIters == 0:
-                erosion = numpy.invert(self.memPred)
+                erosion = numpy.invert(memPred)
             else:
-                erosion = ndimage.morphology.binary_erosion(numpy.invert(self.memPred), iterations=self.slackErosionIters)
-            self.seedMatrix = erosion * self.slackObjId
-            self.seedMatrix = self.seedMatrix[pad:-pad,pad:-pad,pad:-pad]
+                erosion = ndimage.morphology.binary_erosion(numpy.invert(memPred), self.diamond(self.slackErosionIters, self.sampling))
+            seedMatrix = self.newValMatrix(0, dtype=self.labelDtype, isSpill=True)
+            seedMatrix[erosion[pad:-pad,pad:-pad,pad:-pad]] = self.labelFromId(self.slackObjId)
         else:
-            self.seedMatrix = self.newValMatrix(0)
-        self.distMemPred = self.distMemPred[pad:-pad,pad:-pad,pad:-pad]
-        self.distMemPred = self.scaleMatrix(self.distMemPred,0,1)
+            seedMatrix = self.newValMatrix(0, dtype=self.labelDtype, isSpill=True)
+        distMemPred = distMemPred[pad:-pad,pad:-pad,pad:-pad]
+        distMemPred = self.scaleMatrix(distMemPred,0,1)
+        return (distMemPred, seedMatrix)
+
+    def voxelSampling(self):
+        # Voxel scale relative to the finest axis, so that distances remain in voxels along it
+        scale = numpy.array(KnossosModule.knossos.getScale(), dtype="float64")
+        return tuple(map(float, scale / scale.min()))
+
+    def diamond(self, radius, sampling):
+        # Structuring element of the voxels within radius of its center, summing the scaled steps along each axis.
+        # Isotropically, it is what radius iterations by the cross reach, so an erosion by it is the same as those
+        halfSizes = numpy.floor(radius / numpy.array(sampling)).astype("int64")
+        grid = numpy.ogrid[tuple([slice(-halfSize, halfSize + 1) for halfSize in halfSizes])]
+        return sum([abs(axisGrid)*scale for (axisGrid, scale) in zip(grid, sampling)]) <= radius
+
+    def cacheKey(self):
+        key = (self.memPredDir, map(int,self.beginCoord_arr), map(int,self.dims_arr), \
+               self.memThres, self.isSlack, self.slackErosionIters, self.labelDtype, self.sampling)
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def cachePaths(self, key):
+        names = ["dist"]
+        if self.isSlack:
+            names.append("seed")
+        return [(name, os.path.join(self.cacheDir, "%s.%s.npy" % (key, name))) for name in names]
+
+    def loadCachedMatrices(self, key):
+        if self.cacheBytes == 0:
+            return False
+        paths = dict(self.cachePaths(key))
+        if False in map(os.path.isfile, paths.values()):
+            return False
+        for path in paths.values():
+            os.utime(path, None)
+        self.distMemPred = numpy.load(paths["dist"], mmap_mode="r")
+        if self.isSlack:
+            # Copy-on-write, as seeds are set in place
+            self.seedMatrix = numpy.load(paths["seed"], mmap_mode="c")
+        else:
+            self.seedMatrix = self.newValMatrix(0, dtype=self.labelDtype, isSpill=True)
+        return True
+
+    def storeCachedMatrices(self, key):
+        if self.cacheBytes == 0:
+            return
+        try:
+            os.makedirs(self.cacheDir)
+        except:
+            pass
+        matrices = {"dist":self.distMemPred, "seed":self.seedMatrix}
+        for (name, path) in self.cachePaths(key):
+            tmpPath = path + ".tmp"
+            with open(tmpPath, "wb") as f:
+                numpy.save(f, matrices[name])
+            os.rename(tmpPath, path)
+        self.evictCache()
+        # Reopen as memory maps, releasing the computed matrices
+        self.loadCachedMatrices(key)
+        return
+
+    def evictCache(self):
+        entries = {}
+        for name in os.listdir(self.cacheDir):
+            path = os.path.join(self.cacheDir, name)
+            st = os.stat(path)
+            (mtime, size, paths) = entries.get(name.split(".")[0], (0, 0, []))
+            entries[name.split(".")[0]] = (max(mtime, st.st_mtime), size + st.st_size, paths + [path])
+        total = sum([entry[1] for entry in entries.values()])
+        for (mtime, size, paths) in sorted(entries.values()):
+            if total <= self.cacheBytes:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+        return
+
+    def beginMatrices(self, checkpoint=None):
+        self.noApplyMask = False
+        self.orig = self.newMatrix(dims=self.knossos_dims_arr, isSpill=True)
+        self.readMatrix(self.orig)
+        self.WS = self.newValMatrix(0, dtype=self.labelDtype, isSpill=True)
+        self.WS_mask = self.newTrueMatrix(isSpill=True)
+        self.WS_masked = self.newValMatrix(0, dtype=self.labelDtype, isSpill=True)
+        self.writeBuffer = self.newMatrix(dims=self.knossos_dims_arr, isSpill=True)
+        self.writtenLabels = self.newValMatrix(0, dtype=self.labelDtype, dims=self.knossos_dims_arr, isSpill=True)
+        self.isWrittenLabels = False
+        self.wsWriteCount = 0
+        self.changedChunks = set()
+        self.scratch = {}
+        key = self.cacheKey()
+        if not self.loadCachedMatrices(key):
+            self.startEdtPool()
+            # The GUI keeps running meanwhile, so what Begin reads is fixed beforehand and left alone
+            self.isBeginning = True
+            self.beginButton.enabled = False
+            self.resumeButton.enabled = False
+            self.configGroupBox.enabled = False
+            self.prefetchTimer.stop()
+            try:
+                (self.distMemPred, self.seedMatrix) = self.executor.call("begin", self.calcMatrices, (self.memPredDir,))
+            finally:
+                self.isBeginning = False
+                self.beginButton.enabled = True
+                self.resumeButton.enabled = True
+                self.configGroupBox.enabled = True
+                self.prefetchTimer.start(1000)
+            self.storeCachedMatrices(key)
+        if checkpoint is not None:
+            self.resumeMatrices(checkpoint[1])
+        self.countLabels()
+        self.beginSeededDist()
+        self.beginPyramid()
+        self.updateMemoryLabel()
         self.applyMask()
         return
 
+    def updateMemoryLabel(self):
+        matrices = [self.orig, self.WS, self.WS_mask, self.WS_masked, self.writeBuffer, self.writtenLabels, self.seedMatrix, self.distMemPred, self.seededDistMatrix] + self.distPyramid.values()
+        self.memoryLabel.text = "Memory: %.1f MB" % (sum([matrix.nbytes for matrix in matrices])/float(2**20))
+        if self.isSpillBuffers:
+            self.memoryLabel.text += ", spilled to " + self.spillDir
+        return
+
     def endMatrices(self):
         del self.orig
         del self.WS_mask
         del self.WS
         del self.seedMatrix
-        del self.memPred
         del self.distMemPred
+        del self.seededDistMatrix
+        del self.writeBuffer
+        del self.writtenLabels
+        self.distPyramid = {}
+        self.scratch = {}
         return
 
     def finalizeSubObjs(self):
+        # Returns the final ID of each label, slack basins being merged into the slack object
         if not self.isSlack:
             self.mapIdToCoord[self.slackObjId] = self.slackCoord
+            self.mapIdToSlack[self.slackObjId] = True
+            self.mapIdToTodo[self.slackObjId] = False
+        lut = self.labelToId.copy()
         for (Id, coord) in self.mapIdToCoord.items():
             if self.mapIdToSlack[Id] and (not self.IsSlackId(Id)):
-                self.WS[self.WS == Id] = self.slackObjId
+                lut[self.labelFromId(Id)] = self.slackObjId
                 continue
             KnossosModule.segmentation.subobjectFromId(Id, coord)
             objId = KnossosModule.segmentation.largestObjectContainingSubobject(Id,(0,0,0))
             KnossosModule.segmentation.changeComment(objId,"WatershedCubeSegmentor_" + {False:"Done",True:"Todo"}[self.mapIdToTodo[Id]])
-        return
+        return lut
 
     def beginSeeds(self):
         self.noJump = False
@@ -1147,11 +2320,17 @@ Workflow
         self.mapIdToSlack = {}
         self.mapIdToTodo = {}
         self.mapIdToDone = {}
+        self.labelToId = numpy.array([self.invalidId, self.slackObjId], dtype="uint64")
+        self.idToLabel = {self.invalidId:0, self.slackObjId:1}
+        self.labelSizes = numpy.zeros(len(self.labelToId), dtype="int64")
+        self.labelBoxes = {}
+        self.seedStore = self.SeedStore(self.dims_arr)
         return
     
     def beginSlack(self):
         Id = self.slackObjId
-        self.WS = self.calcWS()
+        self.WS[...] = self.calcWS()
+        self.countLabels()
         isDone = False
         coord = self.slackCoord
         self.mapCoordToId[coord] = Id
@@ -1167,6 +2346,12 @@ Workflow
         return
     
     def beginButtonClicked(self):
+        return self.beginCommon(isResume=False)
+
+    def resumeButtonClicked(self):
+        return self.beginCommon(isResume=True)
+
+    def beginCommon(self, isResume):
         retVal = True
         try:
             self.slackObjId = 1L
@@ -1184,6 +2369,26 @@ Workflow
             self.memThres = int(self.memThresEdit.text)
             self.isSlack = self.isSlackCheckBox.isChecked()
             self.slackErosionIters = int(self.slackErosionItersEdit.text)
+            self.sampling = self.voxelSampling()
+            self.memPredDir = self.validateDir(str(self.dirEdit.text))
+            self.cacheDir = str(self.cacheDirEdit.text)
+            self.cacheBytes = long(self.cacheSizeEdit.text)*(2**20)
+            self.edtWorkers = int(self.edtWorkersEdit.text)
+            self.labelDtype = {True:"uint32",False:"int64"}[self.isCompactCheckBox.isChecked()]
+            self.edtSlab = 64
+            self.exportWorkers = 4
+            self.checkpointDir = str(self.checkpointDirEdit.text)
+            self.checkpointSec = int(self.checkpointSecEdit.text)
+            self.checkpointChunk = 32
+            self.spillDir = str(self.spillDirEdit.text)
+            self.isSpillBuffers = self.isSpillBuffersCheckBox.isChecked()
+            self.prefetcher.capacityBytes = long(self.prefetchSizeEdit.text)*(2**20)
+            if self.isSpillBuffers and (not os.path.isdir(self.spillDir)):
+                os.makedirs(self.spillDir)
+            self.isPreview = self.isPreviewCheckBox.isChecked()
+            self.previewFactor = int(self.previewFactorEdit.text)
+            assert(self.previewFactor in [2, 4])
+            self.wsBoxMargin = 1
             self.knossos_beginCoord_arr = numpy.array(self.str2tripint(str(self.workAreaBeginEdit.text)))-numpy.array([1]*3)
             self.beginCoord_arr = self.knossos_beginCoord_arr - self.margin
             self.knossos_endCoord_arr = self.knossos_beginCoord_arr + self.knossos_dims_arr - 1
@@ -1191,13 +2396,20 @@ Workflow
             self.middleX, self.middleY = self.middleCoord_arr[0:2]
             self.setPositionWrap(tuple(self.middleCoord_arr))
             self.beginSeeds()
-            self.beginMatrices()
+            self.checkpointKey = self.cacheKey()
+            checkpoint = None
+            if isResume:
+                checkpoint = self.loadCheckpoint()
+            self.beginMatrices(checkpoint)
             KnossosModule.knossos.setMovementArea(list(self.knossos_beginCoord_arr), list(self.knossos_endCoord_arr))
             self.tableHash = {True:{"Stack":[],"Table":self.doneSubObjTable,"Click":self.doneSubObjTableCellClicked,"DoubleClick":self.doneSubObjTableCellDoubleClicked},\
                               False:{"Stack":[],"Table":self.pendSubObjTable,"Click":self.pendSubObjTableCellClicked,"DoubleClick":self.pendSubObjTableCellDoubleClicked}}
             self.guiBegin()
-            if self.isSlack:
+            if checkpoint is not None:
+                self.resumeSeeds(checkpoint[0])
+            elif self.isSlack:
                 self.beginSlack()
+            self.beginCheckpoints(checkpoint)
             self.active = True
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -1207,36 +2419,252 @@ Workflow
         return retVal
     
     def resetButtonClicked(self):
+        self.cancelPendingSeed()
+        self.executor.flush()
+        # Keep the work just discarded resumable
+        if self.checkpointSec > 0:
+            self.checkpoint()
+            self.checkpointExecutor.flush()
         self.writeMatrix(self.orig)
         self.commonEnd()
         KnossosModule.knossos.resetMovementArea()
         return
 
     def finishButtonClicked(self):
-        self.finalizeSubObjs()
-        self.writeWS(self.WS)
+        self.executor.flush()
+        # Before subobjects are created, so that a loader timeout leaves nothing half done
+        self.waitForLoader()
+        self.writeWS(self.WS, self.finalizeSubObjs())
+        self.removeCheckpoint()
         self.commonEnd()
         return
 
-    def exportMatrix(self,matrix,p,noMargin):
+    def checkpointPaths(self, session, serial):
+        # Volumes are named by session as well, as the serial restarts with every Begin. A metadata file left by
+        # an earlier session thus never names volumes of a later one
+        return (os.path.join(self.checkpointDir, self.checkpointKey + ".json"), \
+                os.path.join(self.checkpointDir, "%s.%s.%d.npz" % (self.checkpointKey, session, serial)))
+
+    def checkpointMeta(self):
+        seeds = [[Id, coord, self.mapIdToMoreCoords[Id], self.mapIdToSlack[Id], self.mapIdToTodo[Id], self.mapIdToDone[Id]] \
+                 for (Id, coord) in self.getSortedMapItems()]
+        stacks = dict([(str(isDone), list(self.tableHash[isDone]["Stack"])) for isDone in [False, True]])
+        return {"seeds":seeds, "stacks":stacks, "curObjId":self.curObjId, "lastObjId":self.lastObjId, \
+                "labelToId":self.labelToId.tolist(), "chunk":self.checkpointChunk}
+
+    def beginCheckpoints(self, checkpoint):
+        # The first checkpoint holds all chunks, unless it builds on the one resumed from
+        self.checkpointedMeta = None
+        self.checkpointSession = "%x" % int(time.time()*1000)
+        self.checkpointSerial = 0
+        self.checkpointBaseSerial = None
+        self.changedChunks = set(xrange(0, int(self.dims_arr[0]), self.checkpointChunk))
+        if checkpoint is not None:
+            self.checkpointSession = checkpoint[0]["session"]
+            self.checkpointSerial = checkpoint[0]["serial"]
+            self.checkpointBaseSerial = self.checkpointSerial
+            self.changedChunks = set()
+        if self.checkpointSec > 0:
+            self.checkpointTimer.start(self.checkpointSec*1000)
+        return
+
+    def checkpointTimerFired(self):
+        if not self.active:
+            return
+        self.checkpoint()
+        return
+
+    def checkpoint(self):
+        # Seeds and the volume chunks changed since the previous checkpoint are snapshot here, then compressed
+        # and written on the checkpoint executor thread. Nothing is written unless something changed, nor while
+        # a seed is still pending
+        if self.pendingSeed is not None:
+            return
+        meta = self.checkpointMeta()
+        if (meta == self.checkpointedMeta) and (len(self.changedChunks) == 0):
+            return
+        chunk = self.checkpointChunk
+        volumes = {}
+        for (name, matrix) in [("WS", self.WS), ("seed", self.seedMatrix)]:
+            for begin in self.changedChunks:
+                volumes["%s_%d" % (name, begin)] = matrix[begin:begin+chunk].copy()
+        self.changedChunks = set()
+        self.checkpointedMeta = meta
+        self.checkpointSerial += 1
+        meta = dict(meta, session=self.checkpointSession, serial=self.checkpointSerial)
+        # Each job builds on the volumes of the previous one, so none may supersede another
+        self.checkpointExecutor.submit("checkpoint%d" % self.checkpointSerial, self.phases.timed("checkpoint", self.writeCheckpoint), \
+                                       (meta, volumes, self.checkpointBaseSerial), lambda result: None, self.checkpointFailed)
+        self.checkpointBaseSerial = self.checkpointSerial
+        return
+
+    def checkpointFailed(self, exc):
+        # Later checkpoints cannot build on this one, so the next holds all chunks
+        QtGui.QMessageBox.information(0, "Error", "Checkpoint failed!\n" + exc)
+        self.checkpointedMeta = None
+        self.checkpointBaseSerial = None
+        self.changedChunks = set(xrange(0, int(self.dims_arr[0]), self.checkpointChunk))
+        return
+
+    def writeCheckpoint(self, meta, volumes, baseSerial):
+        # Unchanged chunks are copied from the volumes of the previous checkpoint. Volumes are written first,
+        # under a new name. The metadata naming them then replaces the previous one, so that a crash at any
+        # point leaves a consistent checkpoint
+        try:
+            os.makedirs(self.checkpointDir)
+        except:
+            pass
+        (metaPath, volumesPath) = self.checkpointPaths(meta["session"], meta["serial"])
+        if baseSerial is not None:
+            base = numpy.load(self.checkpointPaths(meta["session"], baseSerial)[1])
+            try:
+                for name in base.files:
+                    if name not in volumes:
+                        volumes[name] = base[name]
+            finally:
+                base.close()
+        with open(volumesPath + ".tmp", "wb") as f:
+            numpy.savez_compressed(f, **volumes)
+        os.rename(volumesPath + ".tmp", volumesPath)
+        with open(metaPath + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.rename(metaPath + ".tmp", metaPath)
+        self.removeCheckpointVolumes(volumesPath)
+        return
+
+    def removeCheckpointVolumes(self, keepPath=None):
+        if not os.path.isdir(self.checkpointDir):
+            return
+        for name in os.listdir(self.checkpointDir):
+            path = os.path.join(self.checkpointDir, name)
+            if name.startswith(self.checkpointKey + ".") and name.endswith(".npz") and (path <> keepPath):
+                os.remove(path)
+        return
+
+    def removeCheckpoint(self):
+        self.checkpointExecutor.flush()
+        metaPath = self.checkpointPaths(self.checkpointSession, 0)[0]
+        if os.path.isfile(metaPath):
+            os.remove(metaPath)
+        self.removeCheckpointVolumes()
+        return
+
+    def loadCheckpoint(self):
+        metaPath = self.checkpointPaths(None, 0)[0]
+        if not os.path.isfile(metaPath):
+            raise RuntimeError("No checkpoint of this work area and configuration in %s" % self.checkpointDir)
+        with open(metaPath) as f:
+            meta = json.load(f)
+        volumesPath = self.checkpointPaths(meta["session"], meta["serial"])[1]
+        volumes = numpy.load(volumesPath)
+        self.labelToId = numpy.array(meta["labelToId"], dtype="uint64")
+        self.idToLabel = dict([(long(Id), label) for (label, Id) in enumerate(meta["labelToId"])])
+        return (meta, volumes)
+
+    def resumeMatrices(self, volumes):
+        chunk = self.checkpointChunk
+        for (name, matrix) in [("WS", self.WS), ("seed", self.seedMatrix)]:
+            for begin in xrange(0, len(matrix), chunk):
+                matrix[begin:begin+chunk] = volumes["%s_%d" % (name, begin)]
+        return
+
+    def resumeSeeds(self, meta):
+        # Skeleton nodes are recreated, as they were deleted with their trees when the session ended
+        vpId = 0
+        for (Id, coord, moreCoords, isSlack, isTodo, isDone) in meta["seeds"]:
+            Id = long(Id)
+            coord = tuple(coord)
+            moreCoords = map(tuple, moreCoords)
+            self.mapCoordToId[coord] = Id
+            self.mapIdToCoord[Id] = coord
+            self.mapIdToMoreCoords[Id] = moreCoords
+            self.mapIdToSlack[Id] = isSlack
+            self.mapIdToTodo[Id] = isTodo
+            self.mapIdToDone[Id] = isDone
+            if self.IsNormalId(Id):
+                self.seedStore.add(self.coordOffsets([coord] + moreCoords),Id)
+                self.mapIdToNodeId[Id] = self.addNode(coord,self.TreeIdById(Id),vpId)
+                for curCoord in moreCoords:
+                    self.addNode(curCoord,self.TreeIdById(Id),vpId)
+        for isDone in [False, True]:
+            self.tableHash[isDone]["Stack"][:] = map(long, meta["stacks"][str(isDone)])
+        self.refreshTables()
+        self.lastObjId = long(meta["lastObjId"])
+        curObjId = long(meta["curObjId"])
+        if self.IsInvalidId(curObjId):
+            self.applyMask()
+        elif self.mapIdToDone[curObjId]:
+            # Clicking a done row only jumps to it, so its row and basin are selected directly
+            isDone = True
+            self.selectRowWrap(self.tableHash[isDone]["Table"], self.RowFromId(isDone, curObjId))
+            self.selectObjId(curObjId)
+        else:
+            self.tableClickById(curObjId)
+        return
+
+    def exportDtype(self,matrix,lut):
+        # Narrowest dtype holding the exported values. Labels are exported as their IDs
+        if lut is not None:
+            maxVal = lut.max()
+            for dtype in ["uint8","uint16","int32"]:
+                if maxVal <= numpy.iinfo(dtype).max:
+                    return numpy.dtype(dtype)
+            return lut.dtype
+        if matrix.dtype.kind == "f":
+            return numpy.dtype("float32")
+        return matrix.dtype
+
+    def exportSlice(self,matrix,z,lut,dtype,raw,p,inFlight):
+        try:
+            img = matrix[:,:,z]
+            if lut is not None:
+                img = lut[img]
+            img = numpy.ascontiguousarray(img.transpose(), dtype=dtype)
+            raw[z] = img
+            if dtype.itemsize <= 4:
+                Image.fromarray(img).save(os.path.join(p,str(z)+'.tif'))
+        finally:
+            inFlight.release()
+        return
+
+    def exportMatrix(self,matrix,p,noMargin,lut=None):
+        # Writes one TIFF per z-slice, and all slices into volume.raw, a z,y,x ordered array described by
+        # volume.json that numpy.memmap can open. Slices are converted and written by a thread pool, with
+        # a bounded number of slices in flight. IDs beyond 32 bit fit no TIFF and are only written raw
         try:
             os.makedirs(p)
         except:
             pass
         if noMargin:
             matrix = self.matrixNoMargin(matrix)
-        for z in xrange(0, matrix.shape[2]):
-            img = Image.fromarray(matrix[:,:,z].transpose())
-            img.save(os.path.join(p,str(z)+'.tif'))
+        dtype = self.exportDtype(matrix,lut)
+        shape = tuple(reversed(matrix.shape))
+        with open(os.path.join(p,"volume.json"),"w") as f:
+            json.dump({"dtype":dtype.str, "shape":shape, "order":"zyx"}, f)
+        raw = numpy.memmap(os.path.join(p,"volume.raw"), dtype=dtype, mode="w+", shape=shape)
+        inFlight = threading.BoundedSemaphore(2*self.exportWorkers)
+        pool = ThreadPool(self.exportWorkers)
+        try:
+            results = []
+            for z in xrange(0, matrix.shape[2]):
+                inFlight.acquire()
+                results.append(pool.apply_async(self.exportSlice, (matrix,z,lut,dtype,raw,p,inFlight)))
+            for result in results:
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+        raw.flush()
+        del raw
         return
 
     def exportDist(self,p,noMargin=False):
         return self.exportMatrix(self.distMemPred,p,noMargin)
 
     def exportSeeds(self,p,noMargin=False):
-        return self.exportMatrix(self.seedMatrix,p,noMargin)
+        return self.exportMatrix(self.seedMatrix,p,noMargin,lut=self.labelToId)
 
     def exportWS(self,p,noMargin=False):
-        return self.exportMatrix(self.WS,p,noMargin)
+        return self.exportMatrix(self.WS,p,noMargin,lut=self.labelToId)
 
     pass
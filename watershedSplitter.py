@@ -1,12 +1,46 @@
 from PythonQt import QtGui, Qt
 import KnossosModule
-import numpy, traceback, re, time, sys
+import numpy, traceback, re, time, sys, os, multiprocessing, threading, Queue, json, collections, contextlib
 from scipy import ndimage
 from skimage.morphology import watershed
+try:
+    import resource
+except ImportError:
+    # Not on Windows, where the peak rise of phases is not recorded
+    resource = None
 
 #KNOSSOS_PLUGIN	Version	1
 #KNOSSOS_PLUGIN	Description	Splits a misannotated cell into constituent cells using a watershed algorithm on a background distance transform, supplemented by manual border seeding
 
+def edtSlab(args):
+    # Pool worker: EDT of a slab cut along axis 0, with the maximal distance of its
+    # core. The core is returned only if exact, i.e. no core voxel is farther from
+    # its nearest background voxel than from a cut face of the slab
+    (crop, coreBegin, coreEnd, isCutBegin, isCutEnd, sampling) = args
+    if crop.all():
+        return (None, numpy.inf)
+    dist = ndimage.distance_transform_edt(crop, sampling=sampling)[coreBegin:coreEnd]
+    pos = numpy.arange(coreBegin, coreEnd)
+    bound = numpy.empty(len(pos))
+    bound.fill(numpy.inf)
+    if isCutBegin:
+        bound = numpy.minimum(bound, (pos + 1)*sampling[0])
+    if isCutEnd:
+        bound = numpy.minimum(bound, (len(crop) - pos)*sampling[0])
+    maxDist = dist.reshape(len(pos), -1).max(1)
+    if (maxDist > bound).any():
+        return (None, maxDist.max())
+    return (dist.astype("float32"), maxDist.max())
+
+def splitObj(args):
+    # Pool worker: watershed of a queued object's box, from its padded barriers and its seeds
+    (memPredPad, pad, seedMatrix, WS_mask, sampling) = args
+    distMemPred = -ndimage.distance_transform_edt(memPredPad, sampling=sampling).astype("float32")[pad:-pad,pad:-pad,pad:-pad]
+    curMinVal = distMemPred.min()
+    distMemPred = (distMemPred - curMinVal)*(1/(distMemPred.max() - curMinVal))
+    seededDist = distMemPred-((seedMatrix > 0)*1.0)
+    return watershed(seededDist, seedMatrix, None, None, WS_mask)
+
 class main_class(QtGui.QWidget):
     INSTRUCTION_TEXT_STR = """
 Concept:
@@ -18,25 +52,49 @@ Configuration:
   defined upon beginning, this size serves as a cap to restrict working on a larger size
 - Marker Radius - radius of marker for visualizing seed location
 - Base ID - IDs of created subobjects start growing from this number
+- EDT Workers - number of processes computing the distance transform. Distances follow the voxel scale of the
+  dataset, so basins are not stretched along its coarser axes. The processes are forked from knossos upon Begin
+  and kept until the plugin is closed, each a copy of the whole knossos process, so a few suffice. 1 computes in
+  knossos itself
+- Seed Separation - minimal distance (nm) between seeds proposed by Auto Seed, and from the seeds already placed,
+  at least a voxel along each axis
 
 Operation:
 - Click begin. If a work area was not defined beforehand, it would be defined now, so movement is confined to it
 - Press the middle button (or wheel) of the mouse on the misannotated cell you wish to split. This would mask off
   all other cells
 - To seed basins, middle-click them. This would immediately calculate the watershed and update the viewport display
+  The watershed runs in the background, so seeding may go on meanwhile. Only the latest seeding is then calculated
+- Alternatively, press Auto Seed to seed a basin at each local maximum of the distance transform that is farther
+  than the seed separation from a higher one and from the seeds already placed, and calculate the watershed once.
+  Then delete the superfluous proposals, merge those of the same cell, or add seeds and barriers as usual
+- To merge basins, select their rows in the table (Shift or Control+click) and press Merge Seeds. Their seeds
+  become seeds of the basin with the lowest ID
 - To place several seeds for a basin, precede the final middle-click with Shift+middle-click on other seed coordinates
 - Use Ctrl+middle-click to mark barriers. As before, precede this with Shift+middle-click to mark several coordinates
   prior to the final Ctrl+middle-click
 - The table lists basins in normal script and barriers in italic
-- To delete a basin or a barrier, select in the table and press the Delete key
+- To delete basins or barriers, select them in the table and press the Delete key
 - Press the Reset button at any time to cancel all work done
 - Press Finish to write the split cells back to knossos
+- To split several cells in one go, press Queue Object once a cell is seeded. Its seeds are kept and the cells are
+  unmasked, so the next cell may be selected and seeded without rereading the work area. Finish then splits all
+  queued cells in parallel, using as many processes as EDT Workers, along with the current one, and writes them at once
+- The wall time, CPU time and memory of the latest phases (distance transform, watershed, mask, write,
+  waiting for the loader) are shown below the table. Memory is the resident size at the begin and end of a
+  phase, and how much the peak resident size rose during it (n/a where not available). Dump Trace... saves
+  the recent ones to a file, as CSV if its name ends with .csv and as JSON otherwise
+- If the loader is still busy after a minute, the read or write waiting for it is aborted with an error, and
+  may be retried
 """
     SUBOBJECT_TABLE_GROUP_STR = "Subobject Table"
     SUBOBJECT_ID_COLUMN_STR = "ID"
     SUBOBJECT_COORD_COLUMN_STR = "Coordinate"
     SUBOBJECT_MORE_COORDS_COLUMN_STR = "Subseeds Coordinates"
     OBJECT_LIST_COLUMNS = [SUBOBJECT_ID_COLUMN_STR, SUBOBJECT_COORD_COLUMN_STR, SUBOBJECT_MORE_COORDS_COLUMN_STR]
+    LOADER_POLL_MIN_SEC = 0.001
+    LOADER_POLL_MAX_SEC = 0.05
+    LOADER_TIMEOUT_SEC = 60
 
     class BusyCursorScope:
         def __init__(self):
@@ -50,6 +108,257 @@ Operation:
             return
         pass
 
+    class PhaseTimer:
+        # Wall time, CPU time and resident memory of named phases, the latest records kept in a ring buffer.
+        # Memory is the resident size at the begin and end of a phase, and how much the peak resident size of
+        # the process rose during it. CPU time and memory are of the whole process. Phases may be timed on any thread
+        FIELDS = ["phase", "begin", "wall_sec", "cpu_sec", "rss_begin_mb", "rss_end_mb", "peak_rise_mb"]
+
+        def __init__(self, capacity=10000):
+            self.records = collections.deque(maxlen=capacity)
+            self.latest = collections.OrderedDict()
+            self.lock = threading.Lock()
+            return
+
+        def cpuTime(self):
+            times = os.times()
+            return times[0] + times[1]
+
+        def rssMB(self):
+            # Current resident size, where /proc is available
+            try:
+                with open("/proc/self/statm") as f:
+                    pages = int(f.read().split()[1])
+            except (IOError, IndexError, ValueError):
+                return None
+            return pages*os.sysconf("SC_PAGE_SIZE")/1048576.0
+
+        def maxRssMB(self):
+            if resource is None:
+                return None
+            # Kilobytes on Linux, bytes on macOS
+            maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxRss/(1048576.0 if sys.platform == "darwin" else 1024.0)
+
+        def memoryMB(self, val):
+            if val is None:
+                return "n/a"
+            return "%.1f MB" % val
+
+        @contextlib.contextmanager
+        def phase(self, name):
+            (begin, cpu, rssBegin, maxRssBegin) = (time.time(), self.cpuTime(), self.rssMB(), self.maxRssMB())
+            try:
+                yield
+            finally:
+                (wall, cpu) = (time.time() - begin, self.cpuTime() - cpu)
+                maxRssEnd = self.maxRssMB()
+                peakRise = None if maxRssBegin is None else maxRssEnd - maxRssBegin
+                record = (name, begin, wall, cpu, rssBegin, self.rssMB(), peakRise)
+                with self.lock:
+                    self.records.append(record)
+                    self.latest.pop(name, None)
+                    self.latest[name] = record
+            return
+
+        def timed(self, name, func):
+            def timedFunc(*args):
+                with self.phase(name):
+                    return func(*args)
+            return timedFunc
+
+        def breakdown(self):
+            with self.lock:
+                records = self.latest.values()
+            if len(records) == 0:
+                return ""
+            return "\n".join(["%s: %.3f s (CPU %.3f s), memory %s to %s, peak rise %s" % \
+                              (name, wall, cpu, self.memoryMB(rssBegin), self.memoryMB(rssEnd), self.memoryMB(peakRise)) \
+                              for (name, begin, wall, cpu, rssBegin, rssEnd, peakRise) in records])
+
+        def dump(self, path):
+            with self.lock:
+                records = list(self.records)
+            with open(path, "w") as f:
+                if path.lower().endswith(".csv"):
+                    f.write(",".join(self.FIELDS) + "\n")
+                    for record in records:
+                        f.write(",".join([record[0]] + ["" if val is None else repr(val) for val in record[1:]]) + "\n")
+                else:
+                    json.dump([dict(zip(self.FIELDS, record)) for record in records], f, indent=1)
+            return
+        pass
+
+    class Executor:
+        # Runs jobs on a worker thread. Submitting a job of some kind supersedes any earlier job of
+        # that kind, which is then skipped, or its result dropped. Results are handed to callbacks on
+        # the GUI thread as soon as they are ready: the worker wakes the event loop through a pipe
+        # (where it cannot watch one, a timer polls instead), and flush waits on the results queue
+        def __init__(self, pollInterval=20):
+            self.jobs = Queue.Queue()
+            self.results = Queue.Queue()
+            self.generations = {}
+            self.pendingLock = threading.Lock()
+            self.pending = 0
+            self.isCursorSet = False
+            self.timer = None
+            self.wakeFds = None
+            if os.name == "posix":
+                self.wakeFds = os.pipe()
+                self.notifier = Qt.QSocketNotifier(self.wakeFds[0], Qt.QSocketNotifier.Read)
+                self.notifier.activated.connect(self.wake)
+            else:
+                self.timer = Qt.QTimer()
+                self.timer.timeout.connect(self.poll)
+                self.timer.start(pollInterval)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            return
+
+        def addPending(self, count):
+            with self.pendingLock:
+                self.pending += count
+            return
+
+        def submit(self, kind, func, args, onDone, onError=None):
+            generation = self.generations.get(kind, 0) + 1
+            self.generations[kind] = generation
+            self.addPending(1)
+            if not self.isCursorSet:
+                Qt.QApplication.setOverrideCursor(QtGui.QCursor(Qt.Qt.BusyCursor))
+                self.isCursorSet = True
+            self.jobs.put((kind, generation, func, args, onDone, onError))
+            return
+
+        def cancel(self, kind):
+            self.generations[kind] = self.generations.get(kind, 0) + 1
+            return
+
+        def isCurrent(self, kind, generation):
+            return self.generations[kind] == generation
+
+        def run(self):
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                (kind, generation, func, args, onDone, onError) = job
+                if not self.isCurrent(kind, generation):
+                    self.addPending(-1)
+                    continue
+                try:
+                    result = (func(*args), None)
+                except:
+                    result = (None, traceback.format_exc())
+                self.results.put((kind, generation, onDone, onError, result))
+                if self.wakeFds is not None:
+                    os.write(self.wakeFds[1], "r")
+            if self.wakeFds is not None:
+                map(os.close, self.wakeFds)
+            return
+
+        def wake(self, *args):
+            # The pipe is readable, so this does not block
+            os.read(self.wakeFds[0], 4096)
+            self.poll()
+            return
+
+        def poll(self):
+            while True:
+                try:
+                    item = self.results.get_nowait()
+                except Queue.Empty:
+                    break
+                self.handle(item)
+            if self.isCursorSet and (self.pending == 0):
+                Qt.QApplication.restoreOverrideCursor()
+                self.isCursorSet = False
+            return
+
+        def handle(self, item):
+            # Errors of the job, or of its callback, are reported like any other error of the plugin
+            (kind, generation, onDone, onError, (result, exc)) = item
+            self.addPending(-1)
+            if not self.isCurrent(kind, generation):
+                return
+            if exc is None:
+                try:
+                    onDone(result)
+                except:
+                    exc = traceback.format_exc()
+            if exc is None:
+                return
+            if onError is None:
+                QtGui.QMessageBox.information(0, "Error", "Exception caught!\n" + exc)
+            else:
+                onError(exc)
+            return
+
+        def flush(self):
+            # Waits on the results queue, keeping the GUI event loop running meanwhile
+            while self.pending > 0:
+                Qt.QApplication.processEvents()
+                try:
+                    item = self.results.get(timeout=0.01)
+                except Queue.Empty:
+                    continue
+                self.handle(item)
+            self.poll()
+            return
+
+        def call(self, kind, func, args):
+            # Blocks the caller until done, but keeps the GUI event loop running meanwhile
+            outcome = {}
+            self.submit(kind, func, args, lambda result: outcome.update(result=result), lambda exc: outcome.update(exc=exc))
+            self.flush()
+            if "exc" in outcome:
+                raise RuntimeError(outcome["exc"])
+            return outcome["result"]
+
+        def stop(self):
+            # The worker closes the pipe once done, as it may still be writing to it
+            if self.timer is None:
+                self.notifier.setEnabled(False)
+            else:
+                self.timer.stop()
+            self.jobs.put(None)
+            return
+        pass
+
+    class SeedStore:
+        # Seed voxels as an N x 3 array of object box offsets and a parallel array of their IDs,
+        # so that seeds are added and deleted in bulk by single numpy operations
+        def __init__(self, dims):
+            self.dims = tuple(dims)
+            self.offsets = numpy.zeros((0,3), dtype="int64")
+            self.ids = numpy.zeros(0, dtype="uint64")
+            return
+
+        def add(self, offsets, Id):
+            self.offsets = numpy.concatenate([self.offsets, offsets])
+            self.ids = numpy.concatenate([self.ids, numpy.full(len(offsets), Id, dtype="uint64")])
+            return
+
+        def keep(self, isKept):
+            offsets = self.offsets[~isKept]
+            self.offsets = self.offsets[isKept]
+            self.ids = self.ids[isKept]
+            return offsets
+
+        def popIds(self, Ids):
+            return self.keep(numpy.in1d(self.ids, numpy.array(Ids, dtype="uint64"), invert=True))
+
+        def popOffsets(self, offsets):
+            flat = numpy.ravel_multi_index(tuple(offsets.T), self.dims)
+            return self.keep(numpy.in1d(numpy.ravel_multi_index(tuple(self.offsets.T), self.dims), flat, invert=True))
+
+        def relabel(self, Ids, Id):
+            isRelabelled = numpy.in1d(self.ids, numpy.array(Ids, dtype="uint64"))
+            self.ids[isRelabelled] = Id
+            return self.offsets[isRelabelled]
+        pass
+
     class MyTableWidget(QtGui.QTableWidget):
         def __init__(self, delF, parent=None):
             QtGui.QTableWidget.__init__(self,parent)
@@ -80,6 +389,12 @@ Operation:
         configLayout.addWidget(QtGui.QLabel("Size"))
         self.workAreaSizeEdit = QtGui.QLineEdit()
         configLayout.addWidget(self.workAreaSizeEdit)
+        configLayout.addWidget(QtGui.QLabel("EDT Workers"))
+        self.edtWorkersEdit = QtGui.QLineEdit()
+        configLayout.addWidget(self.edtWorkersEdit)
+        configLayout.addWidget(QtGui.QLabel("Seed Separation (nm)"))
+        self.autoSeedSeparationEdit = QtGui.QLineEdit()
+        configLayout.addWidget(self.autoSeedSeparationEdit)
         opButtonsLayout = QtGui.QHBoxLayout()
         widgetLayout.addLayout(opButtonsLayout)
         self.beginButton = QtGui.QPushButton("Begin")
@@ -89,6 +404,18 @@ Operation:
         self.resetButton.enabled = False
         self.resetButton.clicked.connect(self.resetButtonClicked)
         opButtonsLayout.addWidget(self.resetButton)
+        self.autoSeedButton = QtGui.QPushButton("Auto Seed")
+        self.autoSeedButton.enabled = False
+        self.autoSeedButton.clicked.connect(self.autoSeedButtonClicked)
+        opButtonsLayout.addWidget(self.autoSeedButton)
+        self.mergeButton = QtGui.QPushButton("Merge Seeds")
+        self.mergeButton.enabled = False
+        self.mergeButton.clicked.connect(self.mergeButtonClicked)
+        opButtonsLayout.addWidget(self.mergeButton)
+        self.queueButton = QtGui.QPushButton("Queue Object")
+        self.queueButton.enabled = False
+        self.queueButton.clicked.connect(self.queueButtonClicked)
+        opButtonsLayout.addWidget(self.queueButton)
         self.finishButton = QtGui.QPushButton("Finish")
         self.finishButton.enabled = False
         self.finishButton.clicked.connect(self.finishButtonClicked)
@@ -103,6 +430,13 @@ Operation:
         subObjTableLayout = QtGui.QVBoxLayout()
         subObjTableWidget.setLayout(subObjTableLayout)
         subObjTableLayout.addWidget(self.subObjTable)
+        phasesLayout = QtGui.QHBoxLayout()
+        subObjTableLayout.addLayout(phasesLayout)
+        self.phasesLabel = QtGui.QLabel()
+        phasesLayout.addWidget(self.phasesLabel)
+        self.dumpTraceButton = QtGui.QPushButton("Dump Trace...")
+        self.dumpTraceButton.clicked.connect(self.dumpTraceButtonClicked)
+        phasesLayout.addWidget(self.dumpTraceButton)
         self.setTableHeaders(self.subObjTable, self.OBJECT_LIST_COLUMNS)
         self.finalizeTable(self.subObjTable)
         # Instructions
@@ -138,7 +472,7 @@ Operation:
         table.horizontalHeader().setStretchLastSection(True)
         self.resizeTable(table)
         table.setSelectionBehavior(QtGui.QAbstractItemView.SelectRows)
-        table.setSelectionMode(QtGui.QAbstractItemView.SingleSelection)
+        table.setSelectionMode(QtGui.QAbstractItemView.ExtendedSelection)
         return
 
     def applyGuiConfig(self):
@@ -196,6 +530,8 @@ Operation:
         self.settings = [(self.baseSubObjIdEdit,"BASE_SUB_OBJ_ID","10000000"), \
                         (self.workAreaSizeEdit,"WORK_AREA_SIZE",str(tuple([KnossosModule.knossos.getCubeEdgeLength()*2]*3))), \
                         (self.markerRadiusEdit,"MARKER_RADIUS","1"), \
+                        (self.edtWorkersEdit,"EDT_WORKERS",str({True:1,False:min(4, multiprocessing.cpu_count())}[os.name == "nt"])), \
+                        (self.autoSeedSeparationEdit,"AUTO_SEED_SEPARATION","1000"), \
                        (self.widgetWidthEdit,"WIDGET_WIDTH", "0"), \
                        (self.widgetHeightEdit,"WIDGET_HEIGHT", "0")]
         self.loadConfig()
@@ -203,12 +539,17 @@ Operation:
         self.signalConns = []
         self.signalConns.append((KnossosModule.signalRelay.Signal_EventModel_handleMouseReleaseMiddle, self.handleMouseReleaseMiddle))
         self.signalsConnect()
+        self.phases = self.PhaseTimer()
+        self.executor = self.Executor()
+        self.edtPool = None
         return
 
     def uninitLogic(self):
         self.generateGuiConfig()
         self.saveConfig()
         self.signalsDisonnect()
+        self.executor.stop()
+        self.stopEdtPool()
         KnossosModule.scripting.removePluginInstance(__name__, False)
         return
 
@@ -322,37 +663,121 @@ Operation:
     def displayCoord(self,coord):
         return tuple(numpy.array(coord)+1)
 
-    def matrixDelId(self,Id,isSlack):
-        for coordTuple in self.mapIdToSeedTuples[Id]:
-            coord_offset = coordTuple[1]
-            if isSlack:
-                self.memPredPad[tuple(numpy.array(coord_offset)+self.pad)] = True
-            else:
-                self.seedMatrix[coord_offset] = 0
-        del self.mapIdToSeedTuples[Id]
+    def matrixDelIds(self,Ids):
+        slackIds = [Id for Id in Ids if self.mapIdToSlack[Id]]
+        self.barriersChanged(self.seedStore.popIds(slackIds)+self.pad, True)
+        self.seedMatrix[tuple(self.seedStore.popIds(Ids).T)] = 0
         return
 
-    def matrixSetId(self,coordTuples,Id,isSlack):
-        for coordTuple in coordTuples:
-            coord_offset = coordTuple[1]
-            if isSlack:
-                self.memPredPad[tuple(numpy.array(coord_offset)+self.pad)] = False
-            else:
-                self.seedMatrix[coord_offset] = Id
-        self.mapIdToSeedTuples[Id] = coordTuples
+    def barriersChanged(self,padOffsets,val):
+        self.memPredPad[tuple(padOffsets.T)] = val
+        if len(padOffsets) > 0:
+            self.edtChanges.append(padOffsets)
+            self.isDistCurrent = False
+        return
+
+    def matrixSetId(self,offsets,Id,isSlack):
+        if isSlack:
+            self.barriersChanged(offsets+self.pad, False)
+        else:
+            self.seedMatrix[tuple(offsets.T)] = Id
+        self.seedStore.add(offsets,Id)
         return
 
     def addSeed(self, coord, coord_offset, vpId, isSlack=False):
+        offsets = numpy.array([coord_offset] + [curCoord[1] for curCoord in self.moreCoords])
+        self.placeSeed(coord, offsets, vpId, isSlack, [curCoord[0] for curCoord in self.moreCoords])
+        self.refreshTable()
+        self.calcWS()
+        self.moreCoords = []
+        self.updateFinishButton()
+        return
+
+    def placeSeed(self, coord, offsets, vpId, isSlack, moreCoords):
         Id = self.nextId()
-        coordTuples = [(coord, coord_offset, vpId)] + self.moreCoords
-        self.matrixSetId(coordTuples,Id,isSlack)
+        self.matrixSetId(offsets,Id,isSlack)
         self.mapIdToSlack[Id] = isSlack
         self.mapIdToCoord[Id] = coord
         self.mapIdToNodeId[Id] = self.addNode(coord,self.TreeIdById(Id),vpId)
-        self.mapIdToMoreCoords[Id] = [curCoord[0] for curCoord in self.moreCoords]
+        self.mapIdToMoreCoords[Id] = moreCoords
+        return
+
+    def autoSeedButtonClicked(self):
+        # A basin seed at each proposed maximum, all flooded by a single watershed
+        if len(self.moreCoords) > 0:
+            QtGui.QMessageBox.information(0, "Error", "Add the pending additional coordinates first!")
+            return
+        separation = float(self.autoSeedSeparationEdit.text)
+        busyScope = self.BusyCursorScope()
+        self.executor.flush()
+        with self.phases.phase("edt"):
+            self.edtPad = self.currentEDT(self.memPredPad, self.edtPad, self.edtChanges)
+        self.edtChanges = []
+        pad = self.pad
+        offsets = self.distMaxima(self.edtPad[pad:-pad,pad:-pad,pad:-pad], separation, self.seedMatrix != 0)
+        if len(offsets) == 0:
+            QtGui.QMessageBox.information(0, "Error", "No seeds found!")
+            return
+        vpId = 0
+        begin_arr = self.beginCoord_arr + self.objBegin_arr
+        for offset in offsets:
+            coord = tuple([int(val) for val in begin_arr + offset])
+            self.placeSeed(coord, offset.reshape(1,3), vpId, False, [])
+        self.refreshTable()
+        self.calcWS()
+        self.updateFinishButton()
+        return
+
+    def distMaxima(self, dist, separation, seeded):
+        # Offsets of the local maxima of the distance transform, one per plateau, suppressing those within the
+        # separation (nm, an ellipsoid in voxels) of a seeded voxel or of a higher one that is kept. A large
+        # footprint for the maximum filter itself would be far slower
+        radii = numpy.maximum(separation / numpy.array(KnossosModule.knossos.getScale(), dtype="float64"), 1)
+        isMax = (dist == ndimage.maximum_filter(dist, size=3)) & (dist > 0)
+        plateaus, plateauNum = ndimage.label(isMax, numpy.ones((3,3,3)))
+        offsets = numpy.argwhere(isMax)
+        (_, firsts) = numpy.unique(plateaus[tuple(offsets.T)], return_index=True)
+        offsets = offsets[firsts]
+        if seeded.any():
+            # Distances scaled by the radii, so the ellipsoid is their unit sphere
+            seedDist = ndimage.distance_transform_edt(~seeded, sampling=1/radii)
+            offsets = offsets[seedDist[tuple(offsets.T)] > 1]
+        # Greedily from the highest, keeping the earliest plateau among equal ones
+        offsets = offsets[numpy.argsort(-dist[tuple(offsets.T)], kind="mergesort")]
+        kept = numpy.zeros((0,3), dtype="int64")
+        for offset in offsets:
+            if (len(kept) == 0) or (((((kept - offset) / radii)**2).sum(1)) > 1).all():
+                kept = numpy.concatenate([kept, offset.reshape(1,3)])
+        return kept
+
+    def mergeButtonClicked(self):
+        Ids = sorted([self.IdFromRow(row) for row in self.getTableSelectedRow()])
+        if len(Ids) < 2:
+            QtGui.QMessageBox.information(0, "Error", "Select at least two basins to merge!")
+            return
+        if any([self.mapIdToSlack[Id] for Id in Ids]):
+            QtGui.QMessageBox.information(0, "Error", "Barriers cannot be merged!")
+            return
+        self.mergeSeeds(Ids[0], Ids[1:])
+        return
+
+    def mergeSeeds(self, Id, mergedIds):
+        # The seeds of the merged basins are folded into basin Id, their coordinates becoming additional ones of it
+        self.seedMatrix[tuple(self.seedStore.relabel(mergedIds, Id).T)] = Id
+        treeId = self.TreeIdById(Id)
+        for mergedId in mergedIds:
+            coords = [self.mapIdToCoord[mergedId]] + self.mapIdToMoreCoords[mergedId]
+            self.mapIdToMoreCoords[Id] = self.mapIdToMoreCoords[Id] + coords
+            for coord in coords:
+                self.addNode(coord, treeId, 0)
+            del self.mapIdToCoord[mergedId]
+            KnossosModule.skeleton.delete_tree(self.mapIdToTreeId[mergedId])
+            del self.mapIdToTreeId[mergedId]
+            del self.mapIdToNodeId[mergedId]
+            del self.mapIdToSlack[mergedId]
+            del self.mapIdToMoreCoords[mergedId]
         self.refreshTable()
         self.calcWS()
-        self.moreCoords = []
         self.updateFinishButton()
         return
 
@@ -364,14 +789,16 @@ Operation:
         return
 
     def updateFinishButton(self):
-        self.finishButton.enabled = len(self.nonSlacks()) > 1
+        isSplit = len(self.nonSlacks()) > 1
+        self.queueButton.enabled = isSplit
+        self.finishButton.enabled = isSplit or (len(self.queuedObjs) > 0)
         return
     
     def removeSeeds(self,Ids):
         if len(Ids) == 0:
             return
+        self.matrixDelIds(Ids)
         for Id in Ids:
-            self.matrixDelId(Id,self.mapIdToSlack[Id])
             del self.mapIdToCoord[Id]
             KnossosModule.skeleton.delete_tree(self.mapIdToTreeId[Id])
             del self.mapIdToTreeId[Id]
@@ -395,45 +822,136 @@ Operation:
         return IdCoordTuples
 
     def waitForLoader(self):
+        # Polls at a growing interval while pumping events, instead of spinning. After a timeout, raises
+        # rather than reading or writing a region the loader may still be working on
+        loader = KnossosModule.knossos_global_loader
+        if loader.isFinished():
+            return
         busyScope = self.BusyCursorScope()
-        while not KnossosModule.knossos_global_loader.isFinished():
-            Qt.QApplication.processEvents()
-            time.sleep(0)
+        with self.phases.phase("loader"):
+            begin = time.time()
+            interval = self.LOADER_POLL_MIN_SEC
+            while not loader.isFinished():
+                waited = time.time() - begin
+                if waited > self.LOADER_TIMEOUT_SEC:
+                    msg = "Loader still busy after %d s, aborted" % waited
+                    self.phasesLabel.text = msg
+                    QtGui.QMessageBox.information(0, "Error", msg)
+                    raise RuntimeError(msg)
+                if waited > 1:
+                    self.phasesLabel.text = "Waiting for loader: %d s" % waited
+                Qt.QApplication.processEvents()
+                time.sleep(interval)
+                interval = min(2*interval, self.LOADER_POLL_MAX_SEC)
         return
 
     def coordOffset(self,coord):
         return tuple(numpy.array(coord) - self.beginCoord_arr)
 
+    def objOffset(self,coord_offset):
+        # Offset within the object box, None outside of it
+        offset = numpy.array(coord_offset) - self.objBegin_arr
+        if (offset < 0).any() or (offset >= self.WS_mask.shape).any():
+            return None
+        return tuple(offset)
+
     def nonSlacks(self):
         h = self.mapIdToSlack
         return filter(lambda x: not h[x], h)
 
     def calcWS(self):
-        busyScope = self.BusyCursorScope()
         nonSlackIds = self.nonSlacks()
         nonSlackCount = len(nonSlackIds)
-        if nonSlackCount == 0:
-            self.WS_masked[self.WS_mask] = self.curObjId
-        elif nonSlackCount == 1:
-            self.WS_masked[self.WS_mask] = nonSlackIds[0]
-        else:
-            self.distMemPred = -ndimage.distance_transform_edt(self.memPredPad)
+        if nonSlackCount < 2:
+            # Nothing to split, and whatever split is still being computed is obsolete
+            self.executor.cancel("ws")
+            if nonSlackCount == 0:
+                self.WS_masked[self.objBox][self.WS_mask] = self.curObjId
+            else:
+                self.WS_masked[self.objBox][self.WS_mask] = nonSlackIds[0]
+            self.writeObjMatrix(self.WS_masked)
+            return
+        distMemPred = {True:self.distMemPred, False:None}[self.isDistCurrent]
+        # The job gets snapshots of what the GUI thread goes on changing meanwhile
+        self.executor.submit("ws", self.calcSplitWS, (self.memPredPad.copy(), self.edtPad, list(self.edtChanges), distMemPred, self.seedMatrix.copy(), self.WS_mask), self.calcWSDone)
+        return
+
+    def calcSplitWS(self, memPredPad, edtPad, edtChanges, distMemPred, seedMatrix, WS_mask):
+        # Runs on the executor thread. Results are applied on the GUI thread by calcWSDone.
+        # The background EDT is kept, and only updated around the barriers changed since
+        if distMemPred is None:
+            with self.phases.phase("edt"):
+                edtPad = self.currentEDT(memPredPad, edtPad, edtChanges)
             pad = self.pad
-            self.distMemPred = self.distMemPred[pad:-pad,pad:-pad,pad:-pad]
-            self.distMemPred = self.scaleMatrix(self.distMemPred,0,1)
-            seededDist = self.distMemPred-((self.seedMatrix > 0)*1.0)
-            ws = watershed(seededDist, self.seedMatrix, None, None, self.WS_mask)
-            self.WS_masked[self.WS_mask] = ws[self.WS_mask]
-        self.writeMatrix(self.WS_masked)
+            distMemPred = -edtPad[pad:-pad,pad:-pad,pad:-pad]
+            distMemPred = self.scaleMatrix(distMemPred,0,1)
+        seededDist = distMemPred-((seedMatrix > 0)*1.0)
+        with self.phases.phase("watershed"):
+            ws = watershed(seededDist, seedMatrix, None, None, WS_mask)
+        return (edtPad, len(edtChanges), distMemPred, ws)
+
+    def currentEDT(self, memPredPad, edtPad, edtChanges):
+        if edtPad is None:
+            return self.tiledEDT(memPredPad, self.sampling)
+        if len(edtChanges) > 0:
+            self.updateEDT(memPredPad, edtPad, numpy.concatenate(edtChanges))
+        return edtPad
+
+    def updateEDT(self, binary, edt, offsets):
+        # Distances farther from the changed voxels than the largest distance are unchanged. Nearer ones are
+        # recalculated on a crop with a halo, exact if no recalculated distance exceeds the halo, else grown.
+        # Distances are in voxels along the finest axis, so a halo of that many voxels along any axis suffices
+        radius = int(numpy.ceil(edt.max())) + 1
+        shape = numpy.array(binary.shape)
+        coreBegin = numpy.maximum(offsets.min(0) - radius, 0)
+        coreEnd = numpy.minimum(offsets.max(0) + 1 + radius, shape)
+        halo = radius
+        while True:
+            cropBegin = numpy.maximum(coreBegin - halo, 0)
+            cropEnd = numpy.minimum(coreEnd + halo, shape)
+            isWhole = (cropBegin == 0).all() and (cropEnd == shape).all()
+            crop = binary[tuple([slice(begin, end) for (begin, end) in zip(cropBegin, cropEnd)])]
+            if crop.all() and (not isWhole):
+                halo *= 2
+                continue
+            dist = self.tiledEDT(crop, self.sampling)[tuple([slice(begin, end) for (begin, end) in zip(coreBegin - cropBegin, coreEnd - cropBegin)])]
+            if isWhole or (dist.max() <= halo):
+                edt[tuple([slice(begin, end) for (begin, end) in zip(coreBegin, coreEnd)])] = dist
+                return
+            halo = int(numpy.ceil(dist.max())) + 1
+        return
+
+    def calcWSDone(self, result):
+        (self.edtPad, edtChangeCount, self.distMemPred, ws) = result
+        del self.edtChanges[:edtChangeCount]
+        self.isDistCurrent = len(self.edtChanges) == 0
+        self.WS_masked[self.objBox][self.WS_mask] = ws[self.WS_mask]
+        self.writeObjMatrix(self.WS_masked)
         return
 
     def setObjId(self,Id):
         busyScope = self.BusyCursorScope()
         self.curObjId = Id
-        self.WS_mask = self.orig == self.curObjId
-        self.WS_masked[self.WS_mask] = self.orig[self.WS_mask]
-        pad = self.pad
-        self.memPredPad = numpy.pad(self.WS_mask,((pad,pad),)*3,'constant',constant_values=((False,False),)*3)
+        with self.phases.phase("mask"):
+            # Everything from here on works on the object's bounding box plus pad, not the work area
+            WS_mask = self.orig == self.curObjId
+            pad = self.pad
+            box = ndimage.find_objects(WS_mask.view("uint8"))[0]
+            self.objBegin_arr = numpy.array([max(curSlice.start - pad, 0) for curSlice in box])
+            objEnd_arr = numpy.minimum([curSlice.stop + pad for curSlice in box], self.dims_arr)
+            self.objBox = tuple([slice(begin, end) for (begin, end) in zip(self.objBegin_arr, objEnd_arr)])
+            self.WS_mask = WS_mask[self.objBox].copy()
+            del WS_mask
+            self.WS_masked[self.objBox][self.WS_mask] = self.curObjId
+            self.memPredPad = numpy.pad(self.WS_mask,((pad,pad),)*3,'constant',constant_values=((False,False),)*3)
+        self.seedMatrix = self.newValMatrix(0, dims=self.WS_mask.shape)
+        self.seedStore = self.SeedStore(self.WS_mask.shape)
+        self.distMemPred = None
+        self.edtPad = None
+        self.edtChanges = []
+        self.isDistCurrent = False
+        self.autoSeedButton.enabled = True
+        self.mergeButton.enabled = True
         self.writeMatrix(self.WS_masked)
         return
     
@@ -444,16 +962,18 @@ Operation:
         coord_offset = self.coordOffset(coord)
         mods = event.modifiers()
         if self.curObjId == self.invalidId:
-            if mods == 0:
-                self.setObjId(self.orig[coord_offset])
-            else:
+            if mods != 0:
                 QtGui.QMessageBox.information(0, "Error", "First select object!")
+            elif self.orig[coord_offset] in [queuedObj[0] for queuedObj in self.queuedObjs]:
+                QtGui.QMessageBox.information(0, "Error", "Object already queued!")
+            else:
+                self.setObjId(self.orig[coord_offset])
             return
-        if self.WS_mask[coord_offset] == False:
+        coord_offset = self.objOffset(coord_offset)
+        if (coord_offset is None) or (self.WS_mask[coord_offset] == False):
             QtGui.QMessageBox.information(0, "Error", "Click inside mask!")
             return
         if mods == 0:
-            t = time.time()
             self.addSeed(coord,coord_offset,vpId)
         elif mods == Qt.Qt.ShiftModifier:
             self.addMoreCoords(coord,coord_offset,vpId)
@@ -464,23 +984,41 @@ Operation:
     def npDataPtr(self, matrix):
         return matrix.__array_interface__["data"][0]
 
-    def accessMatrix(self, matrix, isWrite):
+    def accessMatrix(self, matrix, isWrite, begin_arr=None):
+        if begin_arr is None:
+            begin_arr = self.beginCoord_arr
         self.waitForLoader()
-        return KnossosModule.knossos.processRegionByStridedBufProxy(list(self.beginCoord_arr), list(self.dims_arr), self.npDataPtr(matrix), matrix.strides, isWrite, True)
+        return KnossosModule.knossos.processRegionByStridedBufProxy(list(begin_arr), list(matrix.shape), self.npDataPtr(matrix), matrix.strides, isWrite, True)
 
     def writeMatrix(self, matrix):
-        self.accessMatrix(matrix, True)
+        with self.phases.phase("write"):
+            self.accessMatrix(matrix, True)
+        self.phasesLabel.text = self.phases.breakdown()
+        return
+
+    def writeObjMatrix(self, matrix):
+        # Only the object box of a work area matrix, outside of it nothing changes while splitting
+        with self.phases.phase("write"):
+            self.accessMatrix(matrix[self.objBox], True, self.beginCoord_arr + self.objBegin_arr)
+        self.phasesLabel.text = self.phases.breakdown()
+        return
+
+    def dumpTraceButtonClicked(self):
+        path = str(QtGui.QFileDialog.getSaveFileName(0, "Dump Trace", "", "JSON (*.json);;CSV (*.csv)"))
+        if path == "":
+            return
+        self.phases.dump(path)
         return
 
     def newMatrix(self,dims=None,dtype=None):
-        if dims == None:
+        if dims is None:
             dims = self.dims_arr
-        if dtype == None:
+        if dtype is None:
             dtype = "uint64"
         return numpy.ndarray(shape=dims, dtype=dtype)
 
-    def newValMatrix(self, val, dtype=None):
-        matrix = self.newMatrix(dtype=dtype)
+    def newValMatrix(self, val, dtype=None, dims=None):
+        matrix = self.newMatrix(dims=dims,dtype=dtype)
         matrix.fill(val)
         return matrix
 
@@ -494,8 +1032,9 @@ Operation:
     def commonEnd(self):
         self.active = False
         self.clearTable()
-        for treeId in self.mapIdToTreeId.values():
+        for treeId in self.mapIdToTreeId.values() + self.queuedTreeIds:
             KnossosModule.skeleton.delete_tree(treeId)
+        self.queuedTreeIds = []
         self.guiEnd()
         self.endMatrices()
         if not self.confined:
@@ -510,45 +1049,155 @@ Operation:
     def guiEnd(self):
         self.beginButton.enabled = True
         self.resetButton.enabled = False
+        self.autoSeedButton.enabled = False
+        self.mergeButton.enabled = False
+        self.queueButton.enabled = False
         self.finishButton.enabled = False
         return
 
+    def voxelSampling(self):
+        # Voxel scale relative to the finest axis, so that distances remain in voxels along it
+        scale = numpy.array(KnossosModule.knossos.getScale(), dtype="float64")
+        return tuple(map(float, scale / scale.min()))
+
     def scaleMatrix(self,m,minVal,maxVal):
         curMinVal = m.min()
         curRange = m.max() - curMinVal
         newRange = maxVal - minVal
         return ((m - curMinVal)*(newRange/curRange))+minVal
 
+    def startEdtPool(self):
+        # Forked from the GUI thread, and kept for later Begins with the same worker count. Each worker is
+        # a fork of the whole knossos process, so only a few are started
+        if (self.edtPool is not None) and (self.edtPoolSize == self.edtWorkers):
+            return
+        self.stopEdtPool()
+        if self.edtWorkers > 1:
+            self.edtPool = multiprocessing.Pool(self.edtWorkers)
+            self.edtPoolSize = self.edtWorkers
+        return
+
+    def stopEdtPool(self):
+        if self.edtPool is None:
+            return
+        self.edtPool.terminate()
+        self.edtPool.join()
+        self.edtPool = None
+        return
+
+    def tiledEDT(self, binary, sampling=None):
+        # Exact float32 EDT, computed on slabs along axis 0, in the EDT pool if started. A slab is cropped with
+        # a halo, and redone with a halo reaching its maximal distance if that was not exact. Only the crops
+        # are held as float64
+        if sampling is None:
+            sampling = (1.0,)*binary.ndim
+        if binary.all():
+            return ndimage.distance_transform_edt(binary, sampling=sampling).astype("float32")
+        n = binary.shape[0]
+        slabNum = max(n / self.edtSlab, 1)
+        dist = numpy.ndarray(shape=binary.shape, dtype="float32")
+        edges = numpy.linspace(0, n, slabNum + 1).astype(int)
+        pending = [(begin, end, self.edtSlab / 2) for (begin, end) in zip(edges[:-1], edges[1:])]
+        mapper = map
+        if self.edtPool is not None:
+            mapper = self.edtPool.map
+        while len(pending) > 0:
+            jobs = []
+            for (begin, end, halo) in pending:
+                cropBegin, cropEnd = max(begin - halo, 0), min(end + halo, n)
+                jobs.append((binary[cropBegin:cropEnd], begin - cropBegin, end - cropBegin, cropBegin > 0, cropEnd < n, sampling))
+            retry = []
+            for ((begin, end, halo), (slab, maxDist)) in zip(pending, mapper(edtSlab, jobs)):
+                if slab is not None:
+                    dist[begin:end] = slab
+                elif numpy.isinf(maxDist):
+                    retry.append((begin, end, 2*halo))
+                else:
+                    retry.append((begin, end, max(2*halo, int(numpy.ceil(maxDist/sampling[0])) + 1)))
+            pending = retry
+        return dist
+
     def beginMatrices(self):
         self.orig = self.newMatrix(dims=self.dims_arr)
         self.readMatrix(self.orig)
-        self.seedMatrix = self.newValMatrix(0)
         self.WS_masked = self.newValMatrix(0)
-        self.distMemPred = self.newValMatrix(0)
+        self.distMemPred = None
+        self.edtPad = None
+        self.edtChanges = []
+        self.isDistCurrent = False
+        self.queuedObjs = []
+        self.queuedTreeIds = []
         return
 
     def endMatrices(self):
         del self.orig
-        del self.seedMatrix
         del self.WS_masked
-        del self.distMemPred
+        self.distMemPred = None
+        self.queuedObjs = []
         if self.curObjId == self.invalidId:
             return
+        del self.seedMatrix
         del self.WS_mask
         del self.memPredPad
+        self.edtPad = None
         return
 
     def finalizeSubObjs(self):
         nonSlackIds = self.nonSlacks()
         firstId = nonSlackIds[0]
-        self.WS_masked[self.WS_masked == firstId] = self.curObjId
-        nonSlackIds[0] = self.curObjId
-        self.mapIdToCoord[self.curObjId] = self.mapIdToCoord[firstId]
-        for Id in nonSlackIds:
-            coord = self.mapIdToCoord[Id]
-            KnossosModule.segmentation.subobjectFromId(Id, coord)
-            objId = KnossosModule.segmentation.largestObjectContainingSubobject(Id,(0,0,0))
-            KnossosModule.segmentation.changeComment(objId,"WatershedSplitter")
+        objMasked = self.WS_masked[self.objBox]
+        objMasked[objMasked == firstId] = self.curObjId
+        self.addSubObjs(self.curObjId, nonSlackIds, self.mapIdToCoord)
+        return
+
+    def addSubObjs(self, objId, nonSlackIds, mapIdToCoord):
+        # The first basin keeps the ID of the split object
+        for (Id, seedId) in zip([objId] + nonSlackIds[1:], nonSlackIds):
+            KnossosModule.segmentation.subobjectFromId(Id, mapIdToCoord[seedId])
+            subObjId = KnossosModule.segmentation.largestObjectContainingSubobject(Id,(0,0,0))
+            KnossosModule.segmentation.changeComment(subObjId,"WatershedSplitter")
+        return
+
+    def queueButtonClicked(self):
+        # The seeded object is kept for Finish as the inputs of its watershed, and unmasked for selecting the next one
+        self.executor.cancel("ws")
+        self.executor.flush()
+        self.waitForLoader()
+        job = (self.memPredPad, self.pad, self.seedMatrix, self.WS_mask, self.sampling)
+        self.queuedObjs.append((self.curObjId, self.objBox, self.nonSlacks(), dict(self.mapIdToCoord), job))
+        self.queuedTreeIds += self.mapIdToTreeId.values()
+        self.baseSubObjId = self.nextId()
+        self.WS_masked[self.objBox][self.WS_mask] = 0
+        self.distMemPred = None
+        self.edtPad = None
+        self.edtChanges = []
+        self.isDistCurrent = False
+        self.beginSeeds()
+        self.autoSeedButton.enabled = False
+        self.mergeButton.enabled = False
+        self.clearTable()
+        self.writeMatrix(self.orig)
+        self.updateFinishButton()
+        return
+
+    def splitQueuedObjs(self):
+        # Queued objects are independent, so their watersheds run in a process pool, and only orig is updated
+        jobs = [queuedObj[-1] for queuedObj in self.queuedObjs]
+        if len(jobs) == 0:
+            return
+        busyScope = self.BusyCursorScope()
+        with self.phases.phase("watershed"):
+            if self.edtPool is None:
+                results = map(splitObj, jobs)
+            else:
+                results = self.edtPool.map(splitObj, jobs)
+        for ((objId, objBox, nonSlackIds, mapIdToCoord, job), ws) in zip(self.queuedObjs, results):
+            WS_mask = job[3]
+            subObjIds = ws[WS_mask].astype("uint64")
+            subObjIds[subObjIds == nonSlackIds[0]] = objId
+            self.orig[objBox][WS_mask] = subObjIds
+            self.addSubObjs(objId, nonSlackIds, mapIdToCoord)
+        self.queuedObjs = []
         return
 
     def beginSeeds(self):
@@ -560,7 +1209,7 @@ Operation:
         self.mapIdToNodeId = {}
         self.mapIdToSlack = {}
         self.mapIdToTodo = {}
-        self.mapIdToSeedTuples = {}
+        self.seedStore = self.SeedStore(self.dims_arr)
         return
 
     def isSizeSmaller(self,smallSize,refSize):
@@ -576,6 +1225,10 @@ Operation:
             self.dims_arr = numpy.array(self.str2tripint(str(self.workAreaSizeEdit.text)))
             self.baseSubObjId = long(str(self.baseSubObjIdEdit.text))
             self.markerRadius = int(self.markerRadiusEdit.text)
+            self.edtWorkers = int(self.edtWorkersEdit.text)
+            self.edtSlab = 64
+            self.sampling = self.voxelSampling()
+            self.startEdtPool()
             movementArea_arr = numpy.array(KnossosModule.knossos.getMovementArea())
             self.movementAreaBegin_arr, self.movementAreaEnd_arr = movementArea_arr[:3], movementArea_arr[3:]+1
             self.movementAreaSize_arr = self.movementAreaEnd_arr - self.movementAreaBegin_arr
@@ -602,13 +1255,20 @@ Operation:
         return retVal
     
     def resetButtonClicked(self):
+        self.executor.cancel("ws")
+        self.executor.flush()
         self.writeMatrix(self.orig)
         self.commonEnd()
         return
 
     def finishButtonClicked(self):
-        self.finalizeSubObjs()
-        self.orig[self.WS_mask] = self.WS_masked[self.WS_mask]
+        self.executor.flush()
+        # Before subobjects are created, so that a loader timeout leaves nothing half done
+        self.waitForLoader()
+        if len(self.nonSlacks()) > 1:
+            self.finalizeSubObjs()
+            self.orig[self.objBox][self.WS_mask] = self.WS_masked[self.objBox][self.WS_mask]
+        self.splitQueuedObjs()
         self.writeMatrix(self.orig)
         self.commonEnd()
         return